@@ -0,0 +1,671 @@
+"""Offline load test for the Audio cog.
+
+Drives simulated servers through play, queue, skip and playlist workloads
+with fake voice clients, a fake youtube_dl and fake ffmpeg players, then
+reports time to audio, thread and task counts, memory and cache behaviour.
+Nothing talks to Discord or YouTube and the bot's data folder isn't touched,
+everything runs in a temporary directory.
+
+    python audio_loadtest.py --servers 50 --workload mixed
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# cogs.audio imports these from __main__, like it does from red.py
+async def send_cmd_help(ctx):
+    pass
+
+settings = types.SimpleNamespace(owner="0",
+                                 get_server_admin=lambda server: "Admin",
+                                 get_server_mod=lambda server: "Mod")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+import discord  # noqa: E402
+from cogs import audio  # noqa: E402
+
+log = logging.getLogger("audio_loadtest")
+
+WORKLOADS = ("play", "queue", "skip", "playlist")
+WATCH_URL = "https://www.youtube.com/watch?v={}"
+PLAYLIST_URL = "https://www.youtube.com/playlist?list=LT{}"
+VIDEO_ID = re.compile(r'[?&]v=([\w-]{11})')
+LIST_ID = re.compile(r'[?&]list=LT(\d+)')
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Catalogue:
+    """Deterministic fake songs with Zipf popularity, so a few songs are
+        requested a lot and the cache has something to hit."""
+
+    def __init__(self, size, min_mb, max_mb, playlist_size, seed):
+        rng = random.Random(seed)
+        self.ids = ["lt{:09d}".format(n) for n in range(size)]
+        self.sizes = {i: int(rng.uniform(min_mb, max_mb) * 10**6)
+                      for i in self.ids}
+        self.playlist_size = playlist_size
+        self.seed = seed
+        weights = [1 / (rank + 1) ** 1.1 for rank in range(size)]
+        total = sum(weights)
+        self._cumulative = []
+        acc = 0
+        for w in weights:
+            acc += w / total
+            self._cumulative.append(acc)
+
+    def pick(self, rng):
+        index = bisect.bisect_left(self._cumulative, rng.random())
+        return self.ids[min(index, len(self.ids) - 1)]
+
+    def playlist(self, number):
+        rng = random.Random(self.seed * 1000 + number)
+        return [self.pick(rng) for _ in range(self.playlist_size)]
+
+    def info(self, video_id):
+        return {"id": video_id, "title": "Load test song " + video_id,
+                "url": WATCH_URL.format(video_id),
+                "webpage_url": WATCH_URL.format(video_id),
+                "duration": 180, "uploader": "audio_loadtest",
+                "view_count": 0, "ext": "webm"}
+
+
+class FakeYoutubeDL:
+    """Stands in for youtube_dl.YoutubeDL, with latency and bandwidth taken
+        from the class attributes the harness sets."""
+
+    catalogue = None
+    info_latency = 0.05
+    search_latency = 0.1
+    page_size = 100  # playlist entries per simulated page fetch
+    bandwidth = 20 * 10**6  # bytes per second, per download
+    chunk_size = 256 * 1024
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def extract_info(self, url, download=True, process=True):
+        playlist = LIST_ID.search(url)
+        if playlist is not None:
+            time.sleep(self.info_latency)
+            return {"_type": "playlist", "id": url,
+                    "entries": self._entries(int(playlist.group(1)))}
+
+        video = VIDEO_ID.search(url)
+        if video is None:  # A search
+            time.sleep(self.search_latency)
+            rng = random.Random(url)
+            return {"entries": [self.catalogue.info(
+                self.catalogue.pick(rng))]}
+
+        time.sleep(self.info_latency)
+        info = self.catalogue.info(video.group(1))
+        if download:
+            self._download(info)
+        return info
+
+    def _entries(self, number):
+        # Lazy, like youtube_dl's paged playlists with process=False
+        for index, video_id in enumerate(self.catalogue.playlist(number)):
+            if index and index % self.page_size == 0:
+                time.sleep(self.info_latency)
+            yield {"_type": "url", "id": video_id, "url": video_id,
+                   "ie_key": "Youtube"}
+
+    def _download(self, info):
+        filename = self.params["outtmpl"] % {"id": info["id"]}
+        if not self.params.get("nopart") and os.path.exists(filename):
+            return
+        target = filename if self.params.get("nopart") else filename + ".part"
+        size = self.catalogue.sizes[info["id"]]
+        written = 0
+        chunk = b"\0" * self.chunk_size
+        with open(target, "wb") as f:
+            while written < size:
+                n = min(self.chunk_size, size - written)
+                time.sleep(n / self.bandwidth)
+                f.write(chunk[:n])
+                f.flush()
+                written += n
+                self._hook({"status": "downloading", "filename": filename,
+                            "downloaded_bytes": written,
+                            "total_bytes": size})
+        if target != filename:
+            os.replace(target, filename)
+        self._hook({"status": "finished", "filename": filename,
+                    "downloaded_bytes": size, "total_bytes": size})
+
+    def _hook(self, status):
+        for hook in self.params.get("progress_hooks", ()):
+            hook(status)
+
+
+class FakePlayer(threading.Thread):
+    """Plays nothing for play_seconds, with the bits of discord.py's
+        players that the cog uses."""
+
+    def __init__(self, harness, server, source, pipe, after):
+        super().__init__()
+        self.daemon = True
+        self.harness = harness
+        self.server = server
+        self.after = after
+        self.volume = 1.0
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._stdin = None
+        if pipe:
+            # ffmpeg gets its own copy of the pipe, the cog closes its one
+            self._stdin = os.fdopen(os.dup(source.fileno()), "rb")
+
+    def run(self):
+        self.harness.player_started(self.server)
+        started = time.monotonic()
+        if self._stdin is not None:
+            with self._stdin:
+                while not self._end.is_set() and self._stdin.read(65536):
+                    pass
+        remaining = self.harness.play_seconds - (time.monotonic() - started)
+        if remaining > 0:
+            self._end.wait(remaining)
+        self._end.set()
+        if self.after is not None:
+            self.after()
+
+    def stop(self):
+        self._end.set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def is_done(self):
+        return self._end.is_set()
+
+    def is_playing(self):
+        return self._resumed.is_set() and not self.is_done()
+
+
+class FakeVoiceClient:
+    def __init__(self, harness, channel):
+        self.harness = harness
+        self.channel = channel
+        self.server = channel.server
+
+    def create_ffmpeg_player(self, filename, *, use_avconv=False, pipe=False,
+                             stderr=None, options=None, before_options=None,
+                             headers=None, after=None):
+        return FakePlayer(self.harness, self.server, filename, pipe, after)
+
+    def create_stream_player(self, stream, *, after=None):
+        return FakePlayer(self.harness, self.server, stream, False, after)
+
+    async def move_to(self, channel):
+        await asyncio.sleep(self.harness.connect_latency)
+        self.channel = channel
+        self.server.me.voice_channel = channel
+
+    async def disconnect(self):
+        self.harness.bot._voice_clients.pop(self.server.id, None)
+        self.server.me.voice_channel = None
+
+
+class FakeServer:
+    def __init__(self, sid):
+        self.id = sid
+        self.name = "Load test server " + sid
+        self.me = FakeMember("bot", self, bot=True)
+        self.user = FakeMember("user" + sid, self)
+        self.voice_channel = FakeChannel("vc" + sid, self)
+        self.voice_channel.voice_members.append(self.user)
+        self.user.voice_channel = self.voice_channel
+
+
+class FakeMember:
+    def __init__(self, mid, server, bot=False):
+        self.id = mid
+        self.name = mid
+        self.server = server
+        self.bot = bot
+        self.roles = []
+        self.voice_channel = None
+        self.mute = False
+
+
+class FakeChannel:
+    def __init__(self, cid, server):
+        self.id = cid
+        self.server = server
+        self.voice_members = []
+
+    def permissions_for(self, member):
+        return types.SimpleNamespace(connect=True, speak=True)
+
+
+class FakeMessage:
+    def __init__(self, server, author, content=""):
+        self.server = server
+        self.author = author
+        self.channel = None
+        self.content = content
+
+
+class FakeContext:
+    def __init__(self, cog, message):
+        self.cog = cog
+        self.message = message
+        self.invoked_subcommand = None
+
+    async def invoke(self, command, *args, **kwargs):
+        return await command.callback(self.cog, self, *args, **kwargs)
+
+
+class FakeBot:
+    def __init__(self, harness, loop):
+        self.harness = harness
+        self.loop = loop
+        self.command_prefix = ["!"]
+        self.cog = None
+        self.servers = []
+        self._servers = {}
+        self._voice_clients = {}  # sid: FakeVoiceClient
+
+    @property
+    def voice_clients(self):
+        return list(self._voice_clients.values())
+
+    def get_cog(self, name):
+        return self.cog if name == "Audio" else None
+
+    def get_server(self, sid):
+        return self._servers.get(sid)
+
+    def get_channel(self, cid):
+        for server in self.servers:
+            if server.voice_channel.id == cid:
+                return server.voice_channel
+        return None
+
+    def voice_client_in(self, server):
+        return self._voice_clients.get(server.id)
+
+    def is_voice_connected(self, server):
+        return server.id in self._voice_clients
+
+    async def join_voice_channel(self, channel):
+        await asyncio.sleep(self.harness.connect_latency)
+        if self.harness.rng.random() < self.harness.args.connect_failures:
+            raise asyncio.TimeoutError
+        voice_client = FakeVoiceClient(self.harness, channel)
+        self._voice_clients[channel.server.id] = voice_client
+        channel.server.me.voice_channel = channel
+        return voice_client
+
+    async def say(self, content=None, *args, **kwargs):
+        return FakeMessage(None, None, content)
+
+    async def reply(self, content=None, *args, **kwargs):
+        return FakeMessage(None, None, content)
+
+    async def edit_message(self, message, new_content=None, *args, **kwargs):
+        message.content = new_content
+        return message
+
+    async def upload(self, *args, **kwargs):
+        return FakeMessage(None, None)
+
+    async def change_presence(self, *args, **kwargs):
+        pass
+
+
+class Harness:
+    def __init__(self, args, loop):
+        self.args = args
+        self.loop = loop
+        self.play_seconds = args.play_seconds
+        self.connect_latency = args.connect_latency
+        self.bot = FakeBot(self, loop)
+        self.rng = random.Random(args.seed)
+        self.cog = None
+        self.starts = {}  # sid: number of players started
+        self.latencies = {"play": [], "queue": [], "skip": [],
+                          "playlist": []}
+        self.errors = 0
+        self.peak_threads = 0
+        self.peak_tasks = 0
+
+    def player_started(self, server):
+        # Called from player threads
+        self.loop.call_soon_threadsafe(self._count_start, server.id)
+
+    def _count_start(self, sid):
+        self.starts[sid] = self.starts.get(sid, 0) + 1
+
+    def setup(self):
+        audio.check_folders()
+        audio.check_files()
+        path = "data/audio/settings.json"
+        with open(path) as f:
+            cog_settings = json.load(f)
+        # No real ffmpeg here, so none of the ffmpeg-only features
+        cog_settings.update({"OPUS_CACHE": False, "SHARED_DECODE": False,
+                             "TITLE_STATUS": False, "VOTE_ENABLED": False,
+                             "MAX_CACHE": self.args.max_cache,
+                             "PROGRESSIVE": self.args.progressive})
+        with open(path, "w") as f:
+            json.dump(cog_settings, f)
+
+        FakeYoutubeDL.catalogue = Catalogue(
+            self.args.catalogue, self.args.min_mb, self.args.max_mb,
+            self.args.playlist_size, self.args.seed)
+        FakeYoutubeDL.info_latency = self.args.info_latency
+        FakeYoutubeDL.search_latency = self.args.info_latency * 2
+        FakeYoutubeDL.bandwidth = self.args.bandwidth * 10**6
+        audio.youtube_dl = types.SimpleNamespace(YoutubeDL=FakeYoutubeDL)
+        # _play only accepts real servers
+        audio.discord.Server = FakeServer
+
+        for n in range(self.args.servers):
+            server = FakeServer(str(n + 1))
+            self.bot.servers.append(server)
+            self.bot._servers[server.id] = server
+
+        self.cog = audio.Audio(self.bot)
+        self.cog.idle_timeout = self.args.idle_timeout
+        self.bot.cog = self.cog
+
+    def context(self, server, content=""):
+        return FakeContext(self.cog, FakeMessage(server, server.user,
+                                                 content))
+
+    async def wait_for_start(self, server, seen, timeout):
+        """Seconds until a player beyond the first `seen` ones starts."""
+        started = time.monotonic()
+        while self.starts.get(server.id, 0) <= seen:
+            if time.monotonic() - started > timeout:
+                log.warning("no audio on server {} after {}s".format(
+                    server.id, timeout))
+                self.errors += 1
+                return None
+            await asyncio.sleep(0.01)
+        return time.monotonic() - started
+
+    async def timed(self, kind, server, coro):
+        seen = self.starts.get(server.id, 0)
+        await coro
+        latency = await self.wait_for_start(server, seen, self.args.timeout)
+        if latency is not None:
+            self.latencies[kind].append(latency)
+
+    async def wait_idle(self, server):
+        started = time.monotonic()
+        while self.cog.is_playing(server) or \
+                len(self.cog.queue.get(server.id) or ()) > 0:
+            if time.monotonic() - started > self.args.timeout:
+                log.warning("server {} still busy after {}s".format(
+                    server.id, self.args.timeout))
+                self.errors += 1
+                return
+            await asyncio.sleep(0.05)
+
+    def song_url(self, rng):
+        return WATCH_URL.format(FakeYoutubeDL.catalogue.pick(rng))
+
+    async def run_server(self, index, server):
+        rng = random.Random(self.args.seed + index)
+        workload = self.args.workload
+        if workload == "mixed":
+            workload = WORKLOADS[index % len(WORKLOADS)]
+        await asyncio.sleep(rng.uniform(0, self.args.ramp))
+
+        play = audio.Audio.play.callback
+        queue = audio.Audio._queue.callback
+        skip = audio.Audio.skip.callback
+
+        if workload == "play":
+            for _ in range(self.args.rounds):
+                await self.timed("play", server, play(
+                    self.cog, self.context(server),
+                    url_or_search_terms=self.song_url(rng)))
+                await self.wait_idle(server)
+        elif workload == "queue":
+            await self.timed("play", server, play(
+                self.cog, self.context(server),
+                url_or_search_terms=self.song_url(rng)))
+            for _ in range(self.args.rounds - 1):
+                await queue(self.cog, self.context(server),
+                            url=self.song_url(rng))
+            await self.wait_idle(server)
+        elif workload in ("skip", "playlist"):
+            if workload == "skip":
+                url = self.song_url(rng)
+            else:
+                url = PLAYLIST_URL.format(rng.randrange(
+                    self.args.playlists))
+            await self.timed(workload, server, play(
+                self.cog, self.context(server), url_or_search_terms=url))
+            if workload == "skip":
+                for _ in range(self.args.rounds - 1):
+                    await queue(self.cog, self.context(server),
+                                url=self.song_url(rng))
+            for _ in range(self.args.rounds - 1):
+                await asyncio.sleep(rng.uniform(0, self.play_seconds / 2))
+                if not self.cog._get_queue(server, 1):
+                    # A blip stops the current song too, nothing left
+                    break
+                await self.timed("skip", server, skip(
+                    self.cog, self.context(server)))
+            await self.cog._stop_and_disconnect(server)
+
+    async def blip(self):
+        """Drops every voice connection, like a gateway outage would."""
+        await asyncio.sleep(self.args.blip)
+        log.warning("dropping {} voice connections".format(
+            len(self.bot._voice_clients)))
+        for sid, voice_client in list(self.bot._voice_clients.items()):
+            del self.bot._voice_clients[sid]
+            voice_client.server.me.voice_channel = None
+            try:
+                voice_client.audio_player.stop()
+            except AttributeError:
+                pass
+
+    async def sample(self):
+        while True:
+            self.peak_threads = max(self.peak_threads,
+                                    threading.active_count())
+            self.peak_tasks = max(self.peak_tasks,
+                                  len(asyncio.Task.all_tasks(loop=self.loop)))
+            await asyncio.sleep(0.05)
+
+    async def run(self):
+        sampler = self.loop.create_task(self.sample())
+        cache_manager = self.loop.create_task(self.cog.cache_manager())
+        if self.args.blip is not None:
+            self.loop.create_task(self.blip())
+        started = time.monotonic()
+        runs = [self.run_server(n, server)
+                for n, server in enumerate(self.bot.servers)]
+        results = await asyncio.gather(*runs, loop=self.loop,
+                                       return_exceptions=True)
+        elapsed = time.monotonic() - started
+        for result in results:
+            if isinstance(result, Exception):
+                self.errors += 1
+                log.error("server run failed", exc_info=result)
+        report = self.report(elapsed)
+        sampler.cancel()
+        cache_manager.cancel()
+        return report
+
+    def report(self, elapsed):
+        perf_report = self.cog._perf_report()
+        counters = perf_report["counters"]
+        cache_files = os.listdir(self.cog.cache_path)
+
+        def stats(values):
+            return {"count": len(values),
+                    "p50": percentile(values, 50),
+                    "p95": percentile(values, 95),
+                    "max": max(values) if values else None}
+
+        memory = {}
+        if resource is not None:
+            # kB on Linux, bytes on macOS
+            memory["max_rss"] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+
+        return {
+            "config": vars(self.args),
+            "elapsed_seconds": elapsed,
+            "errors": self.errors,
+            "players_started": sum(self.starts.values()),
+            "time_to_audio_seconds": {kind: stats(values) for kind, values
+                                      in self.latencies.items() if values},
+            "peak_threads": self.peak_threads,
+            "peak_tasks": self.peak_tasks,
+            "memory": memory,
+            "cache": {"files": len(cache_files),
+                      "size_mb": perf_report["gauges"]["cache_mb"],
+                      "max_mb": perf_report["gauges"]["cache_max_mb"],
+                      "hits": counters.get("cache_hits", 0),
+                      "misses": counters.get("cache_misses", 0),
+                      "info_cache_hits": counters.get("info_cache_hits", 0),
+                      "info_cache_misses": counters.get(
+                          "info_cache_misses", 0)},
+            "voice": {"handshakes": counters.get("voice_handshakes", 0),
+                      "timeouts": counters.get("voice_timeouts", 0),
+                      "reconnects": counters.get("voice_reconnects", 0)},
+            "audio_perf": perf_report}
+
+    def teardown(self):
+        self.bot.cog = None
+        getattr(self.cog, "_Audio__unload")()
+        for voice_client in self.bot.voice_clients:
+            try:
+                voice_client.audio_player.stop()
+            except AttributeError:
+                pass
+
+
+def print_report(report):
+    print("{} servers, {} workload, {:.1f}s, {} players started,"
+          " {} errors".format(report["config"]["servers"],
+                              report["config"]["workload"],
+                              report["elapsed_seconds"],
+                              report["players_started"], report["errors"]))
+    print("\nTime to audio (s)      count      p50      p95      max")
+    for kind, s in sorted(report["time_to_audio_seconds"].items()):
+        print("  {:<18} {:>7} {:>8.3f} {:>8.3f} {:>8.3f}".format(
+            kind, s["count"], s["p50"], s["p95"], s["max"]))
+    print("\nPeak threads: {}   peak tasks: {}".format(
+        report["peak_threads"], report["peak_tasks"]))
+    for key, value in sorted(report["memory"].items()):
+        print("{}: {}".format(key, value))
+    cache = report["cache"]
+    print("\nCache: {files} files, {size_mb:.1f}/{max_mb:.1f} MB,"
+          " {hits} hits / {misses} misses, info cache {info_cache_hits}"
+          " hits / {info_cache_misses} misses".format(**cache))
+    print("Voice: {handshakes} handshakes, {timeouts} timeouts,"
+          " {reconnects} reconnects".format(**report["voice"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--servers", type=int, default=20)
+    parser.add_argument("--workload", default="mixed",
+                        choices=WORKLOADS + ("mixed",))
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="songs played, queued or skipped per server")
+    parser.add_argument("--play-seconds", type=float, default=1.0,
+                        help="how long every fake song plays")
+    parser.add_argument("--ramp", type=float, default=1.0,
+                        help="servers start within this many seconds")
+    parser.add_argument("--catalogue", type=int, default=200)
+    parser.add_argument("--playlists", type=int, default=5)
+    parser.add_argument("--playlist-size", type=int, default=200)
+    parser.add_argument("--min-mb", type=float, default=0.5)
+    parser.add_argument("--max-mb", type=float, default=2.0)
+    parser.add_argument("--bandwidth", type=float, default=20,
+                        help="MB/s per fake download")
+    parser.add_argument("--info-latency", type=float, default=0.05)
+    parser.add_argument("--connect-latency", type=float, default=0.05)
+    parser.add_argument("--connect-failures", type=float, default=0,
+                        help="chance that a voice handshake times out")
+    parser.add_argument("--blip", type=float, default=None,
+                        help="drop all voice connections after this many"
+                             " seconds")
+    parser.add_argument("--max-cache", type=int, default=0,
+                        help="MAX_CACHE in MB, the cog enforces a minimum")
+    parser.add_argument("--progressive", action="store_true")
+    parser.add_argument("--idle-timeout", type=float, default=300)
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="give up waiting for audio after this long")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the temporary data folder")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose
+                        else logging.WARNING)
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+
+    workdir = tempfile.mkdtemp(prefix="audio_loadtest_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    loop = asyncio.get_event_loop()
+    harness = Harness(args, loop)
+    try:
+        harness.setup()
+        report = loop.run_until_complete(harness.run())
+        if args.tracemalloc:
+            report["memory"]["tracemalloc_peak_bytes"] = \
+                tracemalloc.get_traced_memory()[1]
+        harness.teardown()
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print("Data kept in " + workdir, file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,22 @@ import discord
 from discord.ext import commands
 import threading
 import os
-from random import shuffle, choice
-from cogs.utils.dataIO import fileIO
+from random import shuffle, choice, uniform
+from cogs.utils.dataIO import fileIO, dataIO
 from cogs.utils import checks
 from __main__ import send_cmd_help, settings
 import re
 import logging
 import collections
-import copy
+import itertools
 import asyncio
 import math
 import time
+import datetime
 import inspect
+import subprocess
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 __author__ = "tekulvw"
 __version__ = "0.1.1"
@@ -50,6 +54,37 @@ youtube_dl_options = {
     'default_search': 'auto'
 }
 
+# Pre-encoded cache files sit next to the download as <id>.opus
+OPUS_EXT = ".opus"
+OPUS_BITRATE = 64  # kbps
+
+# youtube_dl format selectors. "efficient" prefers small audio-only
+#   Opus/WebM streams at or below the target bitrate, "best" is the old
+#   behaviour. Both fall back to whatever is available.
+FORMAT_POLICIES = {
+    "best": "bestaudio/best",
+    "efficient": "bestaudio[acodec=opus][abr<=?{abr}]/"
+                 "bestaudio[ext=webm][abr<=?{abr}]/"
+                 "bestaudio[abr<=?{abr}]/worstaudio/best"}
+
+# A cache file with a <id>.dl marker next to it is still being downloaded
+PARTIAL_EXT = ".dl"
+PROGRESSIVE_START_BYTES = 256 * 1024
+_progressive = {}  # song id: Downloader progressively writing its file
+_progressive_lock = threading.Lock()
+
+
+def progressive_download(song_id):
+    """The Downloader still progressively downloading song_id, or None."""
+    with _progressive_lock:
+        return _progressive.get(song_id)
+
+
+def format_selector(policy, abr):
+    """youtube_dl format string for a policy and target bitrate (kbps)"""
+    return FORMAT_POLICIES.get(policy, FORMAT_POLICIES["best"]).format(
+        abr=abr)
+
 
 class MaximumLength(Exception):
     def __init__(self, m):
@@ -99,45 +134,561 @@ class InvalidPlaylist(InvalidSong):
     pass
 
 
-class deque(collections.deque):
-    def __init__(self, *args, **kwargs):
+class ServerQueue:
+    """Queue state for a single server.
+
+    Songs are only ever referenced, never copied: upcoming() hands out a
+        shallow, read-only view that is cheap even for 1000 song playlists."""
+
+    __slots__ = ("repeat", "playlist", "voice_channel_id", "queue",
+                 "temp_queue", "now_playing", "queued_at", "requested_at")
+
+    def __init__(self):
+        self.repeat = False
+        self.playlist = False
+        self.voice_channel_id = None
+        self.queue = collections.deque()
+        self.temp_queue = collections.deque()
+        self.now_playing = None
+        self.queued_at = {}  # url: monotonic time it was queued
+        self.requested_at = None  # monotonic time of the last [p]play
+
+    def __len__(self):
+        return len(self.queue) + len(self.temp_queue)
+
+    def clear(self):
+        self.queue = collections.deque()
+        self.temp_queue = collections.deque()
+        self.queued_at = {}
+
+    def mark_queued(self, url):
+        self.queued_at.setdefault(url, time.monotonic())
+
+    def pop_queue_wait(self, url):
+        """Seconds url spent in the queue, None if it wasn't timed."""
+        queued_at = self.queued_at.pop(url, None)
+        if queued_at is None:
+            return None
+        return time.monotonic() - queued_at
+
+    def next_url(self):
+        """URL that would be played next, without removing it."""
+        if self.temp_queue:
+            return self.temp_queue[0]
+        elif self.queue:
+            return self.queue[0]
+        return None
+
+    def upcoming(self, limit, temp=False):
+        """First `limit` entries of the (temp) queue as a tuple."""
+        queue = self.temp_queue if temp else self.queue
+        return tuple(itertools.islice(queue, limit))
+
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (2**18, 2**20, 2**21, 5 * 2**20, 10 * 2**20, 25 * 2**20,
+                 50 * 2**20, 100 * 2**20)
+
+
+class Histogram:
+    """Fixed bucket histogram, percentiles are bucket upper bounds."""
+
+    __slots__ = ("bounds", "counts", "count", "total", "min", "max")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last one is overflow
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.total, "min": self.min,
+                "max": self.max, "mean": self.mean,
+                "p50": self.percentile(50), "p95": self.percentile(95),
+                "buckets": dict(zip([str(b) for b in self.bounds] + ["inf"],
+                                    self.counts))}
+
+
+class AudioPerf:
+    """Counters and histograms for the audio pipeline.
+
+    Updated from downloader threads as well as the event loop, hence the
+        lock."""
+
+    HISTOGRAMS = {"search_seconds": SECONDS_BUCKETS,
+                  "extraction_seconds": SECONDS_BUCKETS,
+                  "download_seconds": SECONDS_BUCKETS,
+                  "download_bytes": BYTES_BUCKETS,
+                  "queue_wait_seconds": SECONDS_BUCKETS,
+                  "time_to_audio_seconds": SECONDS_BUCKETS}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.counters = collections.Counter()
+            self.histograms = {name: Histogram(bounds) for name, bounds
+                               in self.HISTOGRAMS.items()}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def observe(self, name, value):
+        with self._lock:
+            self.histograms[name].observe(value)
+
+    def ratio(self, hits, misses):
+        total = self.counters[hits] + self.counters[misses]
+        return self.counters[hits] / total if total else None
+
+    def to_dict(self):
+        with self._lock:
+            return {"since": self.started_at,
+                    "uptime": time.time() - self.started_at,
+                    "counters": dict(self.counters),
+                    "histograms": {name: h.to_dict() for name, h
+                                   in self.histograms.items()}}
+
+
+perf = AudioPerf()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()  # key: (expires_at, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                return default
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def normalize_search(query):
+    """Search terms that only differ by case or spacing share a cache key."""
+    return " ".join(query.casefold().split())
+
+
+# normalized search terms: YouTube video ID
+search_cache = TTLCache(maxsize=4096, ttl=6 * 60 * 60)
+# compact_entry of the song URL: Song, saves the metadata round-trip for
+# popular songs. Every form of a YouTube link shares the video's entry
+info_cache = TTLCache(maxsize=4096, ttl=60 * 60)
+
+
+def encode_opus(source, destination, use_avconv=False, bitrate=OPUS_BITRATE):
+    """Transcodes source once into an Ogg/Opus file made of 20ms 48kHz
+        stereo frames, which is exactly what Discord expects on the wire."""
+    tmp_file = destination + ".tmp"
+    args = ["avconv" if use_avconv else "ffmpeg", "-loglevel", "error",
+            "-i", source, "-vn", "-ac", "2", "-ar", "48000",
+            "-c:a", "libopus", "-b:a", "{}k".format(bitrate),
+            "-frame_duration", "20", "-f", "ogg", "-y", tmp_file]
+    perf.incr("ffmpeg_spawned")
+    try:
+        subprocess.check_call(args, stdin=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        os.replace(tmp_file, destination)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def iter_ogg_packets(fp):
+    """Yields the Opus packets of an Ogg file, skipping the OpusHead and
+        OpusTags header packets."""
+    partial = b""
+    headers = 2
+    while True:
+        header = fp.read(27)
+        if len(header) < 27:
+            return
+        if header[:4] != b"OggS":
+            raise ValueError("not an Ogg page")
+        lacing = fp.read(header[26])
+        body = fp.read(sum(lacing))
+        offset = 0
+        for size in lacing:
+            partial += body[offset:offset + size]
+            offset += size
+            if size < 255:  # A lacing value under 255 ends the packet
+                if headers:
+                    headers -= 1
+                else:
+                    yield partial
+                partial = b""
+
+
+class OpusPacketPlayer(discord.voice_client.StreamPlayer):
+    """Plays an encode_opus file by sending its packets untouched.
+
+    There's no ffmpeg process and no per-frame encoding, but for the same
+        reason the volume can't be changed."""
+
+    def __init__(self, voice_client, filename, after=None):
+        self._file = open(filename, "rb")
+        super().__init__(self._file, voice_client.encoder,
+                         voice_client._connected, voice_client.play_audio,
+                         after)
+        self.process = None  # Nothing to kill
+
+    def _do_run(self):
+        self.loops = 0
+        self._start = time.time()
+        try:
+            for packet in iter_ogg_packets(self._file):
+                if self._end.is_set():
+                    break
+
+                # are we paused?
+                if not self._resumed.is_set():
+                    # wait until we aren't
+                    self._resumed.wait()
+
+                if not self._connected.is_set():
+                    break
+
+                self.loops += 1
+                self.player(packet, encode=False)
+                next_time = self._start + self.delay * self.loops
+                delay = max(0, self.delay + (next_time - time.time()))
+                time.sleep(delay)
+        finally:
+            self._file.close()
+            self.stop()
+
+
+def pcm_decoder_args(filename, use_avconv=False, start=0):
+    """Command line decoding filename to the raw PCM discord.py sends."""
+    args = ["avconv" if use_avconv else "ffmpeg", "-loglevel", "warning"]
+    if start:
+        args += ["-ss", "{:.2f}".format(start)]
+    return args + ["-i", filename, "-f", "s16le", "-ar", "48000", "-ac", "2",
+                   "pipe:1"]
+
+
+class BroadcastSource(threading.Thread):
+    """Decodes a song once and fans its PCM frames out to the voice clients
+        of every server playing it.
+
+    Frames live in a ring buffer of `window` frames. The decoder stays at
+        most `lookahead` frames ahead of the fastest reader, and a late
+        joiner can attach as long as the first frame hasn't been
+        overwritten yet."""
+
+    FRAME_SIZE = 3840  # 20ms of 48kHz 16-bit stereo
+    FRAME_LENGTH = 0.02
+
+    def __init__(self, filename, use_avconv=False, window=1500,
+                 lookahead=250, on_close=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.daemon = True
+        self.filename = filename
+        self.use_avconv = use_avconv
+        self.window = window
+        self.lookahead = lookahead
+        self.on_close = on_close
+        self.process = None
+        self._ring = [None] * window
+        self._base = 0  # index of the oldest frame still in the ring
+        self._head = 0  # index of the next frame to be decoded
+        self._eof = False
+        self._closed = False
+        self._readers = set()
+        self._cond = threading.Condition()
+
+    def attach(self):
+        """A reader starting at the first frame, or None if it's too late
+            to join this broadcast."""
+        with self._cond:
+            if self._closed or self._base > 0:
+                return None
+            reader = BroadcastReader(self)
+            self._readers.add(reader)
+            return reader
+
+    def detach(self, reader):
+        with self._cond:
+            self._readers.discard(reader)
+            if self._readers:
+                return
+        self.close()
 
-    def peek(self):
-        ret = self.pop()
-        self.append(ret)
-        return copy.deepcopy(ret)
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        try:
+            self.process.kill()
+        except (AttributeError, ProcessLookupError):
+            pass
+        if self.on_close is not None:
+            self.on_close(self)
+
+    @property
+    def listeners(self):
+        return len(self._readers)
 
-    def peekleft(self):
-        ret = self.popleft()
-        self.appendleft(ret)
-        return copy.deepcopy(ret)
+    def run(self):
+        try:
+            perf.incr("ffmpeg_spawned")
+            self.process = subprocess.Popen(
+                pcm_decoder_args(self.filename, self.use_avconv),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL)
+            while True:
+                with self._cond:
+                    while not self._closed and self._readers and \
+                            self._head - max(r.position for r in
+                                             self._readers) >= self.lookahead:
+                        self._cond.wait()
+                    if self._closed:
+                        break
+
+                data = self.process.stdout.read(self.FRAME_SIZE)
+
+                with self._cond:
+                    if data:
+                        if self._head - self._base == self.window:
+                            self._base += 1
+                        self._ring[self._head % self.window] = \
+                            data.ljust(self.FRAME_SIZE, b"\0")
+                        self._head += 1
+                    if len(data) < self.FRAME_SIZE:
+                        self._eof = True
+                    self._cond.notify_all()
+                    if self._eof:
+                        break
+        except Exception:
+            log.exception("broadcast decoder for {} died".format(
+                self.filename))
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+
+    def _read_frame(self, reader):
+        """Next frame for reader, None if it fell out of the window or b""
+            at the end of the song."""
+        with self._cond:
+            while reader.position >= self._head and \
+                    not (self._eof or self._closed):
+                self._cond.wait()
+            if reader.position < self._base:
+                return None
+            if reader.position >= self._head:
+                return b""
+            frame = self._ring[reader.position % self.window]
+            reader.position += 1
+            self._cond.notify_all()  # The decoder might be waiting on us
+            return frame
+
+
+class BroadcastReader:
+    """File-like view of a BroadcastSource at this reader's own offset.
+
+    If it falls out of the source's window, e.g. after a long pause, it
+        carries on from its own offset with a private decoder."""
+
+    def __init__(self, source):
+        self.source = source
+        self.position = 0
+        self._process = None
+
+    def read(self, size):
+        if self._process is None:
+            frame = self.source._read_frame(self)
+            if frame is not None:
+                return frame
+            log.debug("reader fell behind the broadcast of {}".format(
+                self.source.filename))
+            perf.incr("ffmpeg_spawned")
+            self._process = subprocess.Popen(
+                pcm_decoder_args(self.source.filename,
+                                 self.source.use_avconv,
+                                 start=self.position *
+                                 BroadcastSource.FRAME_LENGTH),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL)
+            self.source.detach(self)
+        self.position += 1
+        return self._process.stdout.read(size)
+
+    def close(self):
+        self.source.detach(self)
+        try:
+            self._process.kill()
+        except (AttributeError, ProcessLookupError):
+            pass
 
 
 class Song:
-    def __init__(self, **kwargs):
-        self.__dict__ = kwargs
-        self.title = kwargs.pop('title', None)
-        self.id = kwargs.pop('id', None)
-        self.url = kwargs.pop('url', None)
-        self.webpage_url = kwargs.pop('webpage_url', "")
-        self.duration = kwargs.pop('duration', "")
+    """The bits of a youtube_dl info dict that Audio actually uses.
+
+    Build it with Song.from_info, which throws away formats, thumbnails,
+        descriptions and everything else youtube_dl returns."""
+
+    __slots__ = ("id", "title", "url", "webpage_url", "duration", "creator",
+                 "uploader", "view_count")
+
+    def __init__(self, id=None, title=None, url=None, webpage_url="",
+                 duration=None, creator=None, uploader=None,
+                 view_count=None):
+        self.id = id
+        self.title = title
+        self.url = url
+        self.webpage_url = webpage_url
+        self.duration = duration
+        self.creator = creator
+        self.uploader = uploader
+        self.view_count = view_count
+
+    @classmethod
+    def from_info(cls, info):
+        return cls(**{k: info[k] for k in cls.__slots__
+                      if info.get(k) is not None})
+
+    def __repr__(self):
+        return "<Song id={0.id!r} title={0.title!r}>".format(self)
+
+
+YT_WATCH_URL = re.compile(
+    r'^(?:https?\:\/\/)?(?:www\.|m\.)?(?:youtube\.com\/watch\?v=|youtu\.be\/)'
+    r'([\w-]{11})(?:[&#?].*)?$')
+YT_ID = re.compile(r'^[\w-]{11}$')
+
+
+def compact_entry(url):
+    """YouTube links are stored as their video id, anything else as is."""
+    match = YT_WATCH_URL.match(url)
+    if match:
+        return match.group(1)
+    return url
+
+
+def expand_entry(entry):
+    if YT_ID.match(entry):
+        return "https://www.youtube.com/watch?v={}".format(entry)
+    return entry
 
 
 class Playlist:
+    """A saved playlist.
+
+    Songs are kept as compact entries (see compact_entry) and `playlist`
+        expands them back to URLs. append_song writes a single line to a
+        journal next to the playlist file instead of rewriting it, the
+        journal gets folded back in by save()."""
+
+    max_journal = 200  # appended entries before we rewrite the whole file
+
     def __init__(self, server=None, sid=None, name=None, author=None, url=None,
-                 playlist=None, path=None, main_class=None, **kwargs):
+                 playlist=None, path=None, main_class=None, ids=None,
+                 meta=None, **kwargs):
         self.server = server
         self._sid = sid
         self.name = name
         self.author = author
         self.url = url
         self.main_class = main_class  # reference to Audio
-        self.path = path
+        self._path = path
+        self.index = None  # PlaylistIndex keeping this playlist loaded
+        self.index_key = None
 
         if url is None and "link" in kwargs:
             self.url = kwargs.get('link')
-        self.playlist = playlist
+        if ids is not None:
+            self.entries = list(ids)
+        else:
+            self.entries = [compact_entry(u) for u in playlist or []]
+        self.meta = meta or {}  # entry: [title, duration]
+        self._journal = 0  # entries in the journal file
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        kwargs.update(fileIO(path, 'load'))
+        kwargs['path'] = path
+        playlist = cls(**kwargs)
+
+        try:
+            with open(playlist.journal_path, encoding='utf-8') as f:
+                appended = [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            appended = []
+        playlist.entries.extend(appended)
+        playlist._journal = len(appended)
+        return playlist
+
+    @property
+    def playlist(self):
+        return [expand_entry(e) for e in self.entries]
+
+    @playlist.setter
+    def playlist(self, songlist):
+        self.entries = [compact_entry(u) for u in songlist]
 
     @property
     def filename(self):
@@ -145,9 +696,17 @@ class Playlist:
         f = os.path.join(f, self.sid, self.name + ".txt")
         return f
 
+    @property
+    def path(self):
+        return self._path or self.filename
+
+    @property
+    def journal_path(self):
+        return self.path + ".journal"
+
     def to_json(self):
-        ret = {"author": self.author, "playlist": self.playlist,
-               "link": self.url}
+        ret = {"author": self.author, "ids": self.entries,
+               "meta": self.meta, "link": self.url}
         return ret
 
     def append_song(self, author, url):
@@ -156,11 +715,40 @@ class Playlist:
         elif not self.main_class._valid_playable_url(url):
             raise InvalidURL
         else:
-            self.playlist.append(url)
-            self.save()
+            entry = compact_entry(url)
+            self.entries.append(entry)
+            if self._journal >= self.max_journal:
+                self.save()
+                return
+            with open(self.journal_path, encoding='utf-8', mode='a') as f:
+                f.write(entry + "\n")
+            self._journal += 1
+
+    def remember(self, song):
+        """Caches song's title and duration if it's in this playlist.
+
+        Returns True if that changed anything."""
+        entry = compact_entry(song.webpage_url or "")
+        cached = [song.title, song.duration]
+        if self.meta.get(entry) == cached or entry not in self.entries:
+            return False
+        self.meta[entry] = cached
+        return True
 
     def save(self):
+        head, _ = os.path.split(self.path)
+        if not os.path.exists(head):
+            os.makedirs(head)
         fileIO(self.path, "save", self.to_json())
+        # Even with nothing journaled here, a playlist this one replaces
+        # may have left one behind
+        try:
+            os.remove(self.journal_path)
+        except OSError:
+            pass
+        self._journal = 0
+        if self.index is not None:
+            self.index.saved(self)
 
     @property
     def sid(self):
@@ -172,14 +760,523 @@ class Playlist:
             return None
 
 
+class PlaylistIndex:
+    """Saved playlists, listed and loaded from disk as little as possible.
+
+    A folder is only listed again when its mtime changes and a playlist
+        file only read again when its own does, so files changed outside
+        the bot still show up. The max_loaded most recently used playlists
+        are kept loaded. Global playlists are under the sid None."""
+
+    def __init__(self, path, main_class, max_loaded=32):
+        self.path = path
+        self.main_class = main_class
+        self.max_loaded = max_loaded
+        self._names = {}  # sid: (folder mtime, set of playlist names)
+        # (sid, name): (file mtime, Playlist), least recently used first
+        self._loaded = collections.OrderedDict()
+
+    def _folder(self, sid):
+        if sid is None:
+            return self.path
+        return os.path.join(self.path, sid)
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def _listing(self, sid):
+        folder = self._folder(sid)
+        mtime = self._mtime(folder)
+        cached = self._names.get(sid)
+        if cached is None or cached[0] != mtime:
+            try:
+                files = os.listdir(folder)
+            except FileNotFoundError:
+                files = []
+            names = {f[:-4] for f in files if f.endswith(".txt")}
+            self._names[sid] = cached = (mtime, names)
+            for key in [k for k in self._loaded
+                        if k[0] == sid and k[1] not in names]:
+                del self._loaded[key]  # Removed outside the bot
+        return cached[1]
+
+    def _keep(self, key, playlist):
+        playlist.index = self
+        playlist.index_key = key
+        self._loaded[key] = (self._mtime(playlist.path), playlist)
+        self._loaded.move_to_end(key)
+        while len(self._loaded) > self.max_loaded:
+            self._loaded.popitem(last=False)
+
+    def names(self, sid):
+        return sorted(self._listing(None) | self._listing(sid))
+
+    def exists_local(self, sid, name):
+        return name in self._listing(sid)
+
+    def exists_global(self, name):
+        return name in self._listing(None)
+
+    def load(self, sid, name, local=True):
+        key = (sid if local else None, name)
+        path = os.path.join(self._folder(key[0]), name + ".txt")
+        cached = self._loaded.get(key)
+        if cached is not None and cached[0] == self._mtime(path):
+            self._loaded.move_to_end(key)
+            return cached[1]
+        playlist = Playlist.load(path, sid=sid, name=name,
+                                 main_class=self.main_class)
+        self._keep(key, playlist)
+        return playlist
+
+    def save(self, playlist):
+        playlist.main_class = self.main_class
+        if playlist.index is not self:
+            playlist.index = self
+            playlist.index_key = (playlist.sid, playlist.name)
+        playlist.save()
+        # Coarse mtimes may not show the new file, so add it ourselves
+        self._listing(playlist.index_key[0]).add(playlist.name)
+
+    def saved(self, playlist):
+        """Called by Playlist.save, whichever path saved it, so that its
+            own write doesn't look like an outside change and the saved
+            object is the one load() hands out."""
+        self._keep(playlist.index_key, playlist)
+
+    def replaced(self, playlist):
+        """True if another object took over playlist's file since, e.g.
+            it was recreated or edited outside the bot."""
+        cached = self._loaded.get(playlist.index_key)
+        return cached is not None and cached[1] is not playlist
+
+    def delete(self, sid, name):
+        path = os.path.join(self._folder(sid), name + ".txt")
+        for f in (path, path + ".journal"):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+        self._listing(sid).discard(name)
+        self._loaded.pop((sid, name), None)
+
+    def cached_song(self, url):
+        """A Song built from the metadata cached in loaded playlists."""
+        entry = compact_entry(url)
+        for _, playlist in self._loaded.values():
+            cached = playlist.meta.get(entry)
+            if cached is not None:
+                title, duration = cached
+                return Song(id=entry if YT_ID.match(entry) else None,
+                            title=title, duration=duration, webpage_url=url)
+        return None
+
+    def loaded(self, sid, name):
+        """The playlist if it's been loaded already, without touching the
+            disk otherwise."""
+        cached = self._loaded.get((sid, name)) or \
+            self._loaded.get((None, name))
+        return cached[1] if cached is not None else None
+
+    def song_ids(self):
+        """Cache ids of the YouTube songs in loaded playlists."""
+        ids = set()
+        for _, playlist in self._loaded.values():
+            ids.update(e for e in playlist.entries if YT_ID.match(e))
+        return ids
+
+    def scan(self):
+        """(sid, name, entries, path) of every saved playlist, entries being
+            a copy for loaded playlists and None for the others. Uses the
+            cached listings, so call it on the event loop and hand the
+            result to read_entries."""
+        try:
+            sids = [None] + [d for d in os.listdir(self.path)
+                             if os.path.isdir(os.path.join(self.path, d))]
+        except FileNotFoundError:
+            return []
+        playlists = []
+        for sid in sids:
+            for name in self._listing(sid):
+                cached = self._loaded.get((sid, name))
+                entries = list(cached[1].entries) if cached else None
+                path = os.path.join(self._folder(sid), name + ".txt")
+                playlists.append((sid, name, entries, path))
+        return playlists
+
+    @staticmethod
+    def read_entries(playlists):
+        """(sid, name, entries) for the output of scan, reading the files
+            that weren't loaded. Touches nothing shared, so it can run in
+            an executor."""
+        for sid, name, entries, path in playlists:
+            if entries is None:
+                try:
+                    entries = Playlist.load(path, sid=sid, name=name).entries
+                except Exception:
+                    log.debug("can't read playlist {}".format(path))
+                    continue
+            yield sid, name, entries
+
+
+class PlayHistory:
+    """How often songs got played lately, by compact entry.
+
+    Plays decay with a half-life so old favourites fade out, and only the
+        top max_entries are kept when saving."""
+
+    def __init__(self, path, half_life=7 * 24 * 3600, max_entries=10000):
+        self.path = path
+        self.half_life = half_life
+        self.max_entries = max_entries
+        self._songs = {}  # entry: [score, as of]
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+        if dataIO.is_valid_json(path):
+            self._songs = dataIO.load_json(path)
+
+    def _decayed(self, score, since, now):
+        return score * 0.5 ** ((now - since) / self.half_life)
+
+    def record(self, entry):
+        now = time.time()
+        score, since = self._songs.get(entry, (0, now))
+        self._songs[entry] = [self._decayed(score, since, now) + 1, now]
+        self._dirty = True
+
+    def scores(self):
+        now = time.time()
+        return {entry: self._decayed(score, since, now)
+                for entry, (score, since) in self._songs.items()}
+
+    def save(self, min_interval=0):
+        if not self._dirty or \
+                time.monotonic() - self._saved_at < min_interval:
+            return
+        if len(self._songs) > self.max_entries:
+            scores = self.scores()
+            keep = sorted(scores, key=scores.__getitem__,
+                          reverse=True)[:self.max_entries]
+            self._songs = {entry: self._songs[entry] for entry in keep}
+        dataIO.save_json(self.path, self._songs)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+
+class CacheLedger:
+    """Which servers use which cached songs, for per-server cache quotas.
+
+    A song's size is split evenly between the servers that played it, so a
+        server is only charged its share of songs it has in common with
+        others. Persisted so the accounting survives restarts."""
+
+    def __init__(self, path):
+        self.path = path
+        self._songs = {}  # song_id: {sid: last played}
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+        if dataIO.is_valid_json(path):
+            self._songs = dataIO.load_json(path)
+
+    def touch(self, sid, song_id):
+        self._songs.setdefault(song_id, {})[sid] = time.time()
+        self._dirty = True
+
+    def owners(self, song_id):
+        return self._songs.get(song_id, {})
+
+    def forget(self, song_id):
+        if self._songs.pop(song_id, None) is not None:
+            self._dirty = True
+
+    def prune(self, song_ids):
+        """Forgets every song that isn't in song_ids any more."""
+        for song_id in set(self._songs) - set(song_ids):
+            self.forget(song_id)
+
+    def usage(self, sizes):
+        """sid: MB charged to that server, from song_id: MB on disk.
+
+        Songs nobody played, e.g. prefetched ones, are charged to None."""
+        usage = collections.Counter()
+        for song_id, size in sizes.items():
+            owners = self.owners(song_id) or (None,)
+            for sid in owners:
+                usage[sid] += size / len(owners)
+        return usage
+
+    def plan_eviction(self, sizes, target, protected=(), pinned=()):
+        """Song ids to remove to bring the cache down to target MB.
+
+        Songs nobody played go first. After that the server using the most
+            space, i.e. the one furthest over its fair share, loses its
+            least recently played song, until the total fits. Protected
+            songs are never picked, pinned ones only once nothing else is
+            left."""
+        total = sum(sizes.values())
+        usage = self.usage(sizes)
+        evicted = []
+        gone = set()
+
+        for allow_pinned in (False, True):
+            if total <= target:
+                break
+            candidates = {}  # sid: [(last played, song_id)], newest first
+            for song_id in sizes:
+                if song_id in protected or song_id in gone or \
+                        (song_id in pinned and not allow_pinned):
+                    continue
+                owners = self.owners(song_id) or {None: 0}
+                for sid, played in owners.items():
+                    candidates.setdefault(sid, []).append((played, song_id))
+            for songs in candidates.values():
+                songs.sort(reverse=True)
+
+            while total > target:
+                if candidates.get(None):
+                    sid = None
+                else:
+                    live = [sid for sid, songs in candidates.items() if songs]
+                    if not live:
+                        break
+                    sid = max(live, key=usage.__getitem__)
+                song_id = candidates[sid].pop()[1]
+                if song_id in gone:  # Already evicted through another owner
+                    continue
+                gone.add(song_id)
+                evicted.append(song_id)
+                total -= sizes[song_id]
+                owners = self.owners(song_id) or (None,)
+                for owner in owners:
+                    usage[owner] -= sizes[song_id] / len(owners)
+
+        return evicted
+
+    def save(self, min_interval=0):
+        if not self._dirty or \
+                time.monotonic() - self._saved_at < min_interval:
+            return
+        dataIO.save_json(self.path, self._songs)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+
+def ffprobe(filename):
+    """Title and duration of a local file, (None, None) if unknown."""
+    args = ["ffprobe", "-v", "quiet", "-print_format", "json",
+            "-show_format", filename]
+    try:
+        output = subprocess.check_output(args, stdin=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL)
+        fmt = json.loads(output.decode("utf-8", "replace"))["format"]
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError):
+        return None, None
+
+    tags = {k.lower(): v for k, v in fmt.get("tags", {}).items()}
+    title = tags.get("title")
+    if title and tags.get("artist"):
+        title = "{} - {}".format(tags["artist"], title)
+    try:
+        duration = float(fmt["duration"])
+    except (KeyError, ValueError):
+        duration = None
+    return title, duration
+
+
+class LocalLibrary:
+    """Index of the local playlists in data/audio/localtracks.
+
+    A playlist folder is only listed again when its mtime changes, titles
+        and durations are read with ffprobe in a background pool, and the
+        whole thing is saved so that big libraries load instantly."""
+
+    def __init__(self, path, index_path, loop, workers=4, min_interval=30):
+        self.path = path
+        self.index_path = index_path
+        self.loop = loop
+        self.min_interval = min_interval
+        # name: {"mtime": float,
+        #        "tracks": {filename: {"title": str, "duration": float}}}
+        self.playlists = {}
+        self._last_refresh = None
+        self._search = []  # (casefolded title, playlist, filename)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+        if dataIO.is_valid_json(index_path):
+            self.playlists = dataIO.load_json(index_path)
+        self._build_search()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _build_search(self):
+        self._search = [((track["title"] or filename).casefold(), name,
+                         filename)
+                        for name, playlist in self.playlists.items()
+                        for filename, track in playlist["tracks"].items()]
+
+    def refresh(self, force=False):
+        """Picks up added, removed and changed playlist folders.
+
+        Costs a listdir of the library root and a stat per folder, and
+            does nothing if called again within min_interval seconds."""
+        now = time.monotonic()
+        if not force and self._last_refresh is not None and \
+                now - self._last_refresh < self.min_interval:
+            return
+        self._last_refresh = now
+
+        found = {}
+        for entry in os.listdir(self.path):
+            folder = os.path.join(self.path, entry)
+            if os.path.isdir(folder):
+                found[entry] = os.stat(folder).st_mtime
+
+        changed = False
+        for name in set(self.playlists) - set(found):
+            del self.playlists[name]
+            changed = True
+
+        to_probe = []
+        for name, mtime in found.items():
+            old = self.playlists.get(name)
+            if old is not None and old["mtime"] == mtime:
+                continue
+            old_tracks = old["tracks"] if old is not None else {}
+            tracks = {}
+            for filename in os.listdir(os.path.join(self.path, name)):
+                if filename in old_tracks:
+                    tracks[filename] = old_tracks[filename]
+                else:
+                    tracks[filename] = {"title": None, "duration": None}
+                    to_probe.append((name, filename))
+            self.playlists[name] = {"mtime": mtime, "tracks": tracks}
+            changed = True
+
+        if changed:
+            log.debug("local library changed, {} new tracks".format(
+                len(to_probe)))
+            self._build_search()
+            self.save()
+        if to_probe:
+            self.loop.create_task(self._probe(to_probe))
+
+    async def _probe(self, tracks):
+        futures = [self.loop.run_in_executor(
+            self._executor, ffprobe, os.path.join(self.path, name, filename))
+            for name, filename in tracks]
+        for (name, filename), future in zip(tracks, futures):
+            title, duration = await future
+            try:
+                track = self.playlists[name]["tracks"][filename]
+            except KeyError:  # Removed while we were probing
+                continue
+            track["title"] = title
+            track["duration"] = duration
+        self._build_search()
+        self.save()
+
+    def save(self):
+        dataIO.save_json(self.index_path, self.playlists)
+
+    def playlist_names(self):
+        self.refresh()
+        return sorted(self.playlists)
+
+    def songlist(self, name):
+        self.refresh()
+        return sorted(self.playlists[name]["tracks"])
+
+    def track(self, name, filename):
+        """Index entry of a track, None if we don't know about it."""
+        try:
+            return self.playlists[name]["tracks"][filename]
+        except KeyError:
+            return None
+
+    def search(self, terms, limit=10):
+        """(playlist, filename, title) of tracks whose title or filename
+            contain all of the terms."""
+        self.refresh()
+        words = terms.casefold().split()
+        ret = []
+        for title, name, filename in self._search:
+            if all(w in title or w in filename.casefold() for w in words):
+                ret.append((name, filename,
+                            self.playlists[name]["tracks"][filename]["title"]
+                            or filename))
+                if len(ret) >= limit:
+                    break
+        return ret
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+class GrowingFileFeed(threading.Thread):
+    """Copies a file that's still being downloaded into a pipe, waiting
+        at EOF until the downloader is done instead of stopping.
+
+    Give `feed.stdout` to ffmpeg as its stdin, then close it and start
+        the feed."""
+
+    def __init__(self, filename, downloader, chunk_size=64 * 1024):
+        super().__init__()
+        self.daemon = True
+        self.filename = filename
+        self.downloader = downloader
+        self.chunk_size = chunk_size
+        read_fd, self._write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd, "rb")
+
+    def run(self):
+        try:
+            # out first, so ffmpeg sees EOF even if the file is gone
+            with os.fdopen(self._write_fd, "wb") as out, \
+                    open(self.filename, "rb") as src:
+                while True:
+                    # Checked before reading so the tail isn't missed
+                    done = self.downloader.done.is_set()
+                    chunk = src.read(self.chunk_size)
+                    if chunk:
+                        out.write(chunk)
+                        out.flush()
+                    elif done:
+                        break
+                    else:
+                        self.downloader.done.wait(0.1)
+        except OSError:  # ffmpeg went away or the download failed
+            log.debug("stopped feeding {}".format(self.filename))
+
+
 class Downloader(threading.Thread):
     def __init__(self, url, max_duration=None, download=False,
-                 cache_path="data/audio/cache", *args, **kwargs):
+                 cache_path="data/audio/cache", ytdl_format=None,
+                 progressive=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.url = url
         self.max_duration = max_duration
+        self.ytdl_format = ytdl_format
+        # Download straight into the cache file and set `ready` once the
+        #   first chunk has landed, so playback can start early
+        self.progressive = progressive
+        self.ready = threading.Event()
         self.done = threading.Event()
+        self._done_callbacks = []
+        self._ready_callbacks = []
+        self._callback_lock = threading.Lock()
         self.song = None
+        self.entries = None  # Only set for playlists
         self.failed = False
         self._download = download
         self.hit_max_length = threading.Event()
@@ -194,39 +1291,304 @@ class Downloader(threading.Thread):
             self.hit_max_length.set()
         except:
             self.failed = True
-        self.done.set()
+        self._set_ready()
+        with self._callback_lock:
+            self.done.set()
+            callbacks, self._done_callbacks = self._done_callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Calls callback(downloader) once this downloader has finished.
+
+        The callback runs in the downloader's thread, or immediately if
+            it's already done."""
+        with self._callback_lock:
+            if not self.done.is_set():
+                self._done_callbacks.append(callback)
+                return
+        callback(self)
+
+    def add_ready_callback(self, callback):
+        """Like add_done_callback, but calls callback(downloader) as soon
+            as `ready` is set."""
+        with self._callback_lock:
+            if not self.ready.is_set():
+                self._ready_callbacks.append(callback)
+                return
+        callback(self)
+
+    def _set_ready(self):
+        with self._callback_lock:
+            if self.ready.is_set():
+                return
+            self.ready.set()
+            callbacks, self._ready_callbacks = self._ready_callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def _ytdl_options(self):
+        options = dict(youtube_dl_options)
+        if self.ytdl_format is not None:
+            options["format"] = self.ytdl_format
+        if self.progressive:
+            # No .part file, the cache file itself grows as we download
+            options["nopart"] = True
+            options["progress_hooks"] = [self._progress_hook]
+        return options
+
+    def _progress_hook(self, status):
+        if status.get("status") == "finished" or \
+                (status.get("downloaded_bytes") or 0) >= \
+                PROGRESSIVE_START_BYTES:
+            self._set_ready()
 
     def download(self):
         self.duration_check()
 
         if not os.path.isfile('data/audio/cache' + self.song.id):
-            video = self._yt.extract_info(self.url)
-            self.song = Song(**video)
+            filename = os.path.join("data/audio/cache", self.song.id)
+            partial = filename + PARTIAL_EXT
+            if self.progressive:
+                with _progressive_lock:
+                    owner = _progressive.get(self.song.id)
+                    if owner is None:
+                        if os.path.isfile(filename) and \
+                                not os.path.isfile(partial):
+                            return  # Already cached
+                        _progressive[self.song.id] = self
+                if owner is not None:
+                    # Someone else is writing the file, finish along with them
+                    owner.ready.wait()
+                    self._set_ready()
+                    owner.done.wait()
+                    if owner.failed:
+                        raise RuntimeError("download of songid {} failed"
+                                           "".format(self.song.id))
+                    return
+                open(partial, "w").close()
+                # youtube_dl skips files that exist, e.g. from a crash
+                _remove_file(filename)
+            started = time.monotonic()
+            try:
+                video = self._yt.extract_info(self.url)
+                song = Song.from_info(video)
+            except:
+                if self.progressive:
+                    _remove_file(filename)
+                raise
+            finally:
+                if self.progressive:
+                    _remove_file(partial)
+                    with _progressive_lock:
+                        del _progressive[self.song.id]
+            perf.observe("download_seconds", time.monotonic() - started)
+            self.song = song
+            info_cache.put(compact_entry(self.url), self.song)
+            try:
+                perf.observe("download_bytes", os.path.getsize(
+                    os.path.join("data/audio/cache", self.song.id)))
+            except (OSError, TypeError):
+                pass
 
     def duration_check(self):
         log.debug("duration {} for songid {}".format(self.song.duration,
                                                      self.song.id))
-        if self.max_duration and self.song.duration > self.max_duration:
+        if self.max_duration and self.song.duration and \
+                self.song.duration > self.max_duration:
             log.debug("songid {} too long".format(self.song.id))
             raise MaximumLength("songid {} has duration {} > {}".format(
                 self.song.id, self.song.duration, self.max_duration))
 
     def get_info(self):
         if self._yt is None:
-            self._yt = youtube_dl.YoutubeDL(youtube_dl_options)
-        if "[SEARCH:]" not in self.url:
-            video = self._yt.extract_info(self.url, download=False,
-                                          process=False)
+            self._yt = youtube_dl.YoutubeDL(self._ytdl_options())
+        if "[SEARCH:]" in self.url:
+            query = self.url[9:]
+            key = normalize_search(query)
+            yt_id = search_cache.get(key)
+            if yt_id is None:
+                perf.incr("search_cache_misses")
+                started = time.monotonic()
+                yt_id = self._yt.extract_info(
+                    query, download=False)["entries"][0]["id"]
+                # Should handle errors here ^
+                perf.observe("search_seconds", time.monotonic() - started)
+                search_cache.put(key, yt_id)
+            else:
+                perf.incr("search_cache_hits")
+                log.debug("search cache hit on {!r}".format(key))
+            self.url = expand_entry(yt_id)
+
+        song = info_cache.get(compact_entry(self.url))
+        if song is not None:
+            perf.incr("info_cache_hits")
+            log.debug("info cache hit on {}".format(self.url))
+            self.song = song
+            return
+
+        perf.incr("info_cache_misses")
+        started = time.monotonic()
+        video = self._yt.extract_info(self.url, download=False,
+                                      process=False)
+        perf.observe("extraction_seconds", time.monotonic() - started)
+
+        self.song = Song.from_info(video)
+        self.entries = video.get("entries")
+        if self.entries is None:
+            info_cache.put(compact_entry(self.url), self.song)
+
+
+class PlaylistStreamer(threading.Thread):
+    """Enumerates a playlist and hands song URLs to the event loop as
+        youtube_dl pages through it, instead of all at once at the end.
+
+    Use `await streamer.get()` until it returns None."""
+
+    def __init__(self, url, loop, entry_url, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.url = url
+        self.loop = loop
+        self.entry_url = entry_url  # entry dict -> song URL
+        self.count = 0
+        self.failed = False
+        self._urls = asyncio.Queue(loop=loop)
+        self._cancelled = threading.Event()
+
+    def run(self):
+        try:
+            yt = youtube_dl.YoutubeDL(youtube_dl_options)
+            info = yt.extract_info(self.url, download=False, process=False)
+            # With process=False YouTube playlists come back as a generator
+            #   that fetches the next page when it's exhausted
+            for entry in info.get("entries") or ():
+                if self._cancelled.is_set():
+                    break
+                try:
+                    song_url = self.entry_url(entry)
+                except (KeyError, IndexError, TypeError):
+                    continue
+                self.count += 1
+                self.loop.call_soon_threadsafe(self._urls.put_nowait,
+                                               song_url)
+        except:
+            log.exception("failed to enumerate playlist {}".format(self.url))
+            self.failed = True
+        self.loop.call_soon_threadsafe(self._urls.put_nowait, None)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    async def get(self):
+        """Next song URL, or None once the playlist is exhausted."""
+        return await self._urls.get()
+
+
+class VoiceManager:
+    """Owns connecting, moving and reconnecting voice clients.
+
+    At most max_handshakes connections are negotiated at once and failed
+        attempts are retried after a jittered exponential backoff, so that
+        a gateway blip doesn't have every server reconnecting at the same
+        moment and timing out. Concurrent requests for the same server
+        share one attempt."""
+
+    def __init__(self, bot, max_handshakes=5, attempts=5, base_delay=1,
+                 max_delay=60):
+        self.bot = bot
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._handshakes = asyncio.Semaphore(max_handshakes, loop=bot.loop)
+        self._pending = {}  # sid: (channel id, Task)
+
+    def backoff(self, attempt):
+        """Seconds to wait after the attempt-th failure (full jitter)."""
+        return uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _task(self, channel):
+        sid = channel.server.id
+        channel_id, task = self._pending.get(sid, (None, None))
+        if task is not None and not task.done():
+            if channel_id == channel.id:
+                return task
+            # Heading somewhere else now, go there once that's settled
+            task = self.bot.loop.create_task(self._connect(channel, task))
         else:
-            self.url = self.url[9:]
-            yt_id = self._yt.extract_info(
-                self.url, download=False)["entries"][0]["id"]
-            # Should handle errors here ^
-            self.url = "https://youtube.com/watch?v={}".format(yt_id)
-            video = self._yt.extract_info(self.url, download=False,
-                                          process=False)
+            task = self.bot.loop.create_task(self._connect(channel))
+        self._pending[sid] = (channel.id, task)
+
+        def forget(task):
+            if self._pending.get(sid, (None, None))[1] is task:
+                del self._pending[sid]
+
+        task.add_done_callback(forget)
+        return task
+
+    async def connect(self, channel):
+        """Connects or moves to channel, returns the voice client.
+
+        Raises ConnectTimeout once every attempt timed out, and
+            discord.ClientException straight away for anything but
+            finding ourselves already connected."""
+        return await asyncio.shield(self._task(channel), loop=self.bot.loop)
+
+    def reconnect(self, channel, callback):
+        """Connects to channel in the background and calls callback(server)
+            once it's back."""
+        def done(task):
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                log.warning("giving up reconnecting to channel {}: {}".format(
+                    channel.id, task.exception()))
+                return
+            callback(channel.server)
+
+        self._task(channel).add_done_callback(done)
+
+    def reconnecting(self, server):
+        return server.id in self._pending
 
-        self.song = Song(**video)
+    def close(self):
+        for channel_id, task in self._pending.values():
+            task.cancel()
+        self._pending = {}
+
+    async def _connect(self, channel, previous=None):
+        if previous is not None:
+            await asyncio.wait([previous], loop=self.bot.loop)
+        server = channel.server
+
+        for attempt in range(self.attempts):
+            voice_client = self.bot.voice_client_in(server)
+            try:
+                if voice_client is None:
+                    with (await self._handshakes):
+                        perf.incr("voice_handshakes")
+                        return await self.bot.join_voice_channel(channel)
+                if voice_client.channel.id != channel.id:
+                    with (await self._handshakes):
+                        perf.incr("voice_moves")
+                        await voice_client.move_to(channel)
+                return voice_client
+            except asyncio.TimeoutError:
+                perf.incr("voice_timeouts")
+            except discord.ClientException:
+                # Only "already connected" is worth another go, picking up
+                #   the client that beat us to it. Anything else won't fix
+                #   itself by retrying.
+                if voice_client is not None or \
+                        self.bot.voice_client_in(server) is None:
+                    raise
+                continue
+            delay = self.backoff(attempt)
+            log.debug("voice connect {} to channel {} failed, retrying in"
+                      " {:.1f}s".format(attempt + 1, channel.id, delay))
+            await asyncio.sleep(delay)
+
+        raise ConnectTimeout("We timed out connecting to voice channel {}"
+                             " {} times".format(channel.id, self.attempts))
 
 
 class Audio:
@@ -234,17 +1596,72 @@ class Audio:
 
     def __init__(self, bot):
         self.bot = bot
-        self.queue = {}  # add deque's, repeat
+        self.queue = {}  # sid: ServerQueue
         self.downloaders = {}  # sid: object
         self.settings = fileIO("data/audio/settings.json", 'load')
+        self._settings_dirty = False
+        self._settings_save = None  # TimerHandle of the pending save
+        self.settings_save_delay = 5
         self.server_specific_setting_keys = ["VOLUME", "VOTE_ENABLED",
                                              "VOTE_THRESHOLD"]
         self.cache_path = "data/audio/cache"
+        self.cache_ledger = CacheLedger("data/audio/cache_ledger.json")
+        self.cache_low_watermark = 0.9  # evict down to this much of the max
+        self.play_history = PlayHistory("data/audio/play_history.json")
+        self._warmed = set()  # song ids pre-downloaded by _warm_cache
+        self._warming = False
+        self.warmup_delay = 5  # seconds between warm-up downloads
+        self.warmup_playlist_weight = 0.25  # a play is worth 1
         self.local_playlist_path = "data/audio/localtracks"
+        self.playlist_index = PlaylistIndex("data/audio/playlists", self)
+        self._playlist_saves = {}  # Playlist: TimerHandle
+        self.resolve_concurrency = 10
+        self._resolve_semaphore = asyncio.Semaphore(self.resolve_concurrency,
+                                                    loop=self.bot.loop)
+        self.local_library = LocalLibrary(self.local_playlist_path,
+                                          "data/audio/local_index.json",
+                                          self.bot.loop)
         self._old_game = False
 
         self.skip_votes = {}
 
+        self._players = {}  # sid: queue_player task
+        self._wakeups = {}  # sid: asyncio.Event
+        self._opus_encoding = set()  # song ids being pre-encoded
+        self._opus_pending = collections.OrderedDict()  # song ids to encode
+        self._opus_lock = threading.Lock()
+        self.opus_workers = 1  # Opus pre-encodes running at once
+        self._opus_executor = ThreadPoolExecutor(
+            max_workers=self.opus_workers)
+        self._broadcasts = {}  # filename: BroadcastSource
+        self._broadcast_lock = threading.Lock()
+
+        self.idle_timeout = 300  # seconds not playing before we d/c
+        self._idle_timers = {}  # sid: TimerHandle
+        self.voice = VoiceManager(self.bot)
+
+        for sid in self.settings["SERVERS"]:
+            self._fill_server_settings(sid)
+
+    def __unload(self):
+        for task in self._players.values():
+            task.cancel()
+        self._players = {}
+        for timer in self._idle_timers.values():
+            timer.cancel()
+        self._idle_timers = {}
+        self.voice.close()
+        self._flush_settings()
+        for playlist, timer in self._playlist_saves.items():
+            timer.cancel()
+            if not self.playlist_index.replaced(playlist):
+                playlist.save()
+        self._playlist_saves = {}
+        self.local_library.close()
+        self._opus_executor.shutdown(wait=False)
+        self.cache_ledger.save()
+        self.play_history.save()
+
     async def _add_song_status(self, song):
         if self._old_game is False:
             self._old_game = list(self.bot.servers)[0].me.game
@@ -256,17 +1673,22 @@ class Audio:
     def _add_to_queue(self, server, url):
         if server.id not in self.queue:
             self._setup_queue(server)
-        self.queue[server.id]["QUEUE"].append(url)
+        self.queue[server.id].queue.append(url)
+        self.queue[server.id].mark_queued(url)
+        self._wake_player(server)
 
     def _add_to_temp_queue(self, server, url):
         if server.id not in self.queue:
             self._setup_queue(server)
-        self.queue[server.id]["TEMP_QUEUE"].append(url)
+        self.queue[server.id].temp_queue.append(url)
+        self.queue[server.id].mark_queued(url)
+        self._wake_player(server)
 
     def _addleft_to_queue(self, server, url):
         if server.id not in self.queue:
-            self._setup_queue()
-        self.queue[server.id]["QUEUE"].appendleft(url)
+            self._setup_queue(server)
+        self.queue[server.id].queue.appendleft(url)
+        self._wake_player(server)
 
     def _cache_desired_files(self):
         filelist = []
@@ -288,16 +1710,72 @@ class Audio:
         return max([60, 48 * math.log(x) * x**0.3])  # log is not log10
 
     def _cache_required_files(self):
-        queue = copy.deepcopy(self.queue)
         filelist = []
-        for server in queue:
-            now_playing = queue[server].get("NOW_PLAYING")
+        for server_queue in self.queue.values():
+            now_playing = server_queue.now_playing
             try:
                 filelist.append(now_playing.id)
             except AttributeError:
                 pass
         return filelist
 
+    def _cache_file_id(self, filename):
+        """Song id a cache file belongs to, e.g. for <id>.opus"""
+        return filename.split(".", 1)[0]
+
+    def _cache_songs(self):
+        """song_id: [cache filenames], e.g. <id> and <id>.opus"""
+        songs = {}
+        for file in os.listdir(self.cache_path):
+            songs.setdefault(self._cache_file_id(file), []).append(file)
+        return songs
+
+    def _cache_song_sizes(self, songs):
+        """song_id: MB on disk, for the output of _cache_songs"""
+        sizes = {}
+        for song_id, files in songs.items():
+            size = 0
+            for file in files:
+                try:
+                    size += os.path.getsize(
+                        os.path.join(self.cache_path, file))
+                except OSError:
+                    pass
+            sizes[song_id] = size / 10**6
+        return sizes
+
+    def _evict_cache(self):
+        """Shrinks the cache below its max, fairly between servers.
+
+        Songs that are playing or about to are kept, songs in loaded
+            playlists only go when nothing else can."""
+        songs = self._cache_songs()
+        sizes = self._cache_song_sizes(songs)
+        protected = set(self._cache_required_files())
+        protected.update(self._cache_desired_files())
+        target = self._cache_max() * self.cache_low_watermark
+
+        pinned = self.playlist_index.song_ids() | self._warmed
+        evicted = self.cache_ledger.plan_eviction(sizes, target, protected,
+                                                  pinned)
+        dumped = 0
+        for song_id in evicted:
+            for file in songs[song_id]:
+                try:
+                    os.remove(os.path.join(self.cache_path, file))
+                except OSError:
+                    # A directory got in the cache, or the file is in use
+                    pass
+            dumped += sizes[song_id]
+            del songs[song_id]
+        self._warmed.difference_update(evicted)
+        self.cache_ledger.prune(songs)
+        self.cache_ledger.save()
+
+        log.debug("evicted {} songs, {} MB of audio files".format(
+            len(evicted), dumped))
+        return dumped
+
     def _cache_size(self):
         songs = os.listdir(self.cache_path)
         size = sum(map(lambda s: os.path.getsize(
@@ -312,13 +1790,15 @@ class Audio:
     def _clear_queue(self, server):
         if server.id not in self.queue:
             return
-        self.queue[server.id]["QUEUE"] = deque()
-        self.queue[server.id]["TEMP_QUEUE"] = deque()
+        self.queue[server.id].clear()
 
-    async def _create_ffmpeg_player(self, server, filename, local=False):
+    async def _create_ffmpeg_player(self, server, filename, local=False,
+                                    downloader=None):
         """This function will guarantee we have a valid voice client,
-            even if one doesn't exist previously."""
-        voice_channel_id = self.queue[server.id]["VOICE_CHANNEL_ID"]
+            even if one doesn't exist previously.
+
+        If downloader is given the file is still being downloaded by it."""
+        voice_channel_id = self.queue[server.id].voice_channel_id
         voice_client = self.voice_client(server)
 
         if voice_client is None:
@@ -332,10 +1812,10 @@ class Audio:
                                         " REKT.")
             log.debug("valid reconnect channel for sid"
                       " {}, reconnecting...".format(server.id))
-            await self._join_voice_channel(to_connect)  # SHIT
+            voice_client = await self._join_voice_channel(to_connect)
         elif voice_client.channel.id != voice_channel_id:
             # This was decided at 3:45 EST in #advanced-testing by 26
-            self.queue[server.id]["VOICE_CHANNEL_ID"] = voice_client.channel.id
+            self.queue[server.id].voice_channel_id = voice_client.channel.id
             log.debug("reconnect chan id for sid {} is wrong, fixing".format(
                 server.id))
 
@@ -348,6 +1828,7 @@ class Audio:
 
         use_avconv = self.settings["AVCONV"]
         options = '-b:a 64k -bufsize 64k'
+        opus_filename = song_filename + OPUS_EXT
 
         try:
             voice_client.audio_player.process.kill()
@@ -359,8 +1840,39 @@ class Audio:
 
         log.debug("making player on sid {}".format(server.id))
 
-        voice_client.audio_player = voice_client.create_ffmpeg_player(
-            song_filename, use_avconv=use_avconv, options=options)
+        if not local and downloader is not None:
+            log.debug("playing {} while it downloads".format(song_filename))
+            feed = GrowingFileFeed(song_filename, downloader)
+            perf.incr("progressive_players")
+            perf.incr("ffmpeg_spawned")
+            voice_client.audio_player = voice_client.create_ffmpeg_player(
+                feed.stdout, pipe=True, use_avconv=use_avconv,
+                options=options, after=self._player_after(server.id))
+            feed.stdout.close()  # ffmpeg has its own end of the pipe
+            feed.start()
+        elif not local and self.settings["OPUS_CACHE"] and \
+                os.path.isfile(opus_filename):
+            log.debug("playing pre-encoded {}".format(opus_filename))
+            perf.incr("opus_players")
+            voice_client.audio_player = OpusPacketPlayer(
+                voice_client, opus_filename,
+                after=self._player_after(server.id))
+        elif not local and self.settings["SHARED_DECODE"]:
+            reader = self._broadcast_reader(song_filename)
+            after = self._player_after(server.id)
+
+            def close_reader():
+                reader.close()
+                after()
+
+            perf.incr("shared_players")
+            voice_client.audio_player = voice_client.create_stream_player(
+                reader, after=close_reader)
+        else:
+            perf.incr("ffmpeg_spawned")
+            voice_client.audio_player = voice_client.create_ffmpeg_player(
+                song_filename, use_avconv=use_avconv, options=options,
+                after=self._player_after(server.id))
 
         # Set initial volume
         vol = self.get_server_settings(server)['VOLUME'] / 100
@@ -368,23 +1880,42 @@ class Audio:
 
         return voice_client  # Just for ease of use, it's modified in-place
 
+    def _broadcast_reader(self, filename):
+        """Attaches to the broadcast of filename, starting a new decoder if
+            nobody is playing it or it's too far along to join."""
+        with self._broadcast_lock:
+            source = self._broadcasts.get(filename)
+            reader = source.attach() if source is not None else None
+            if reader is not None:
+                log.debug("sharing the decoder of {} with {} others".format(
+                    filename, source.listeners - 1))
+                return reader
+
+            source = BroadcastSource(filename, self.settings["AVCONV"],
+                                     on_close=self._broadcast_closed)
+            reader = source.attach()
+            self._broadcasts[filename] = source
+        source.start()
+        return reader
+
+    def _broadcast_closed(self, source):
+        with self._broadcast_lock:
+            if self._broadcasts.get(source.filename) is source:
+                del self._broadcasts[source.filename]
+
     # TODO: _current_playlist
 
     # TODO: _current_song
 
     def _delete_playlist(self, server, name):
-        if not name.endswith('.txt'):
-            name = name + ".txt"
-        try:
-            os.remove(os.path.join('data/audio/playlists', server.id, name))
-        except OSError:
-            pass
-        except WindowsError:
-            pass
+        if name.endswith('.txt'):
+            name = name[:-4]
+        self.playlist_index.delete(server.id, name)
 
     # TODO: _disable_controls()
 
     async def _disconnect_voice_client(self, server):
+        self._disarm_idle_timer(server)
         if not self.voice_connected(server):
             return
 
@@ -396,16 +1927,9 @@ class Audio:
         """
         Doesn't actually download, just get's info for uses like queue_list
         """
-        downloaders = []
-        for url in url_list:
-            d = Downloader(url)
-            d.start()
-            downloaders.append(d)
-
-        while any([d.is_alive() for d in downloaders]):
-            await asyncio.sleep(0.1)
-
-        songs = [d.song for d in downloaders]
+        songs = []
+        for future in self._resolve_batch(url_list):
+            songs.append(await future)
         return songs
 
     async def _download_next(self, server, curr_dl, next_dl):
@@ -417,10 +1941,10 @@ class Audio:
             #   There's no reason to wait if we can't compare
             return
 
-        max_length = self.settings["MAX_LENGTH"]
+        await self._wait_for_downloader(next_dl)
 
-        while next_dl.is_alive():
-            await asyncio.sleep(0.5)
+        if curr_dl.song is None or next_dl.song is None:
+            return
 
         if curr_dl.song.id != next_dl.song.id:
             log.debug("downloader ID's mismatch on sid {}".format(server.id) +
@@ -430,8 +1954,13 @@ class Audio:
                 next_dl.duration_check()
             except MaximumLength:
                 return
-            self.downloaders[server.id] = Downloader(next_dl.url, max_length,
-                                                     download=True)
+            if progressive_download(next_dl.song.id) is not None:
+                return
+            self.downloaders[server.id] = self._make_downloader(
+                next_dl.url, download=True)
+            if self.settings["OPUS_CACHE"]:
+                self.downloaders[server.id].add_done_callback(
+                    lambda d: d.song and self._ensure_opus(d.song.id))
             self.downloaders[server.id].start()
 
     def _dump_cache(self, ignore_desired=False):
@@ -444,8 +1973,9 @@ class Audio:
         prev_size = self._cache_size()
 
         for file in os.listdir(self.cache_path):
-            if file not in reqd:
-                if ignore_desired or file not in opt:
+            song_id = self._cache_file_id(file)
+            if song_id not in reqd:
+                if ignore_desired or song_id not in opt:
                     try:
                         os.remove(os.path.join(self.cache_path, file))
                     except OSError:
@@ -482,57 +2012,43 @@ class Audio:
         if server.id not in self.queue:
             return []
 
-        ret = []
-        for i in range(limit):
-            try:
-                ret.append(self.queue[server.id]["QUEUE"][i])
-            except IndexError:
-                pass
-
-        return ret
+        return list(self.queue[server.id].upcoming(limit))
 
     def _get_queue_nowplaying(self, server):
         if server.id not in self.queue:
             return None
 
-        return self.queue[server.id]["NOW_PLAYING"]
+        return self.queue[server.id].now_playing
 
     def _get_queue_playlist(self, server):
         if server.id not in self.queue:
             return None
 
-        return self.queue[server.id]["PLAYLIST"]
+        return self.queue[server.id].playlist
 
     def _get_queue_repeat(self, server):
         if server.id not in self.queue:
             return None
 
-        return self.queue[server.id]["REPEAT"]
+        return self.queue[server.id].repeat
 
     def _get_queue_tempqueue(self, server, limit):
         if server.id not in self.queue:
             return []
 
-        ret = []
-        for i in range(limit):
-            try:
-                ret.append(self.queue[server.id]["TEMP_QUEUE"][i])
-            except IndexError:
-                pass
-        return ret
+        return list(self.queue[server.id].upcoming(limit, temp=True))
 
     async def _guarantee_downloaded(self, server, url):
-        max_length = self.settings["MAX_LENGTH"]
         if server.id not in self.downloaders:  # We don't have a downloader
             log.debug("sid {} not in downloaders, making one".format(
                 server.id))
-            self.downloaders[server.id] = Downloader(url, max_length)
+            self.downloaders[server.id] = self._make_downloader(url)
 
         if self.downloaders[server.id].url != url:  # Our downloader is old
             # I'm praying to Jeezus that we don't accidentally lose a running
             #   Downloader
             log.debug("sid {} in downloaders but wrong url".format(server.id))
-            self.downloaders[server.id] = Downloader(url, max_length)
+            self.downloaders[server.id] = self._make_downloader(url)
 
         try:
             # We're assuming we have the right thing in our downloader object
@@ -542,8 +2058,8 @@ class Audio:
             # Queue manager already started it for us, isn't that nice?
             pass
 
-        # Getting info w/o download
-        self.downloaders[server.id].done.wait()
+        # Getting info w/o download, or the start of a progressive one
+        await self._wait_until_playable(self.downloaders[server.id])
 
         # This will throw a maxlength exception if required
         self.downloaders[server.id].duration_check()
@@ -553,42 +2069,74 @@ class Audio:
 
         # Now we check to see if we have a cache hit
         cache_location = os.path.join(self.cache_path, song.id)
-        if not os.path.exists(cache_location):
+        # Checked first: the partial marker is gone by the time it's done
+        downloading = progressive_download(song.id)
+        partial = os.path.isfile(cache_location + PARTIAL_EXT)
+        if not os.path.exists(cache_location) or \
+                (partial and downloading is None):
             log.debug("cache miss on song id {}".format(song.id))
-            self.downloaders[server.id] = Downloader(url, max_length,
-                                                     download=True)
+            perf.incr("cache_misses")
+            self.downloaders[server.id] = self._make_downloader(
+                url, download=True)
             self.downloaders[server.id].start()
 
-            while self.downloaders[server.id].is_alive():
-                await asyncio.sleep(0.5)
+            await self._wait_until_playable(self.downloaders[server.id])
 
             song = self.downloaders[server.id].song
+        elif partial:
+            # Another server is downloading it right now, play along
+            log.debug("songid {} is being downloaded, sharing it".format(
+                song.id))
+            perf.incr("cache_hits")
+            await self._wait_until_playable(downloading)
         else:
             log.debug("cache hit on song id {}".format(song.id))
+            perf.incr("cache_hits")
 
         return song
 
+    def _make_downloader(self, url, download=False):
+        """Downloader following the format policy and progressive setting"""
+        ytdl_format = format_selector(self.settings["FORMAT_POLICY"],
+                                      self.settings["TARGET_ABR"])
+        return Downloader(url, self.settings["MAX_LENGTH"], download=download,
+                          ytdl_format=ytdl_format,
+                          progressive=download and
+                          self.settings["PROGRESSIVE"])
+
     def _is_queue_playlist(self, server):
         if server.id not in self.queue:
             return False
 
-        return self.queue[server.id]["PLAYLIST"]
+        return self.queue[server.id].playlist
 
     async def _join_voice_channel(self, channel):
         server = channel.server
-        if server.id in self.queue:
-            self.queue[server.id]["VOICE_CHANNEL_ID"] = channel.id
-        try:
-            await self.bot.join_voice_channel(channel)
-        except asyncio.futures.TimeoutError as e:
-            log.exception(e)
-            raise ConnectTimeout("We timed out connecting to a voice channel")
+        if server.id not in self.queue:
+            self._setup_queue(server)
+        # Remembered so that we can reconnect here
+        self.queue[server.id].voice_channel_id = channel.id
+        voice_client = await self.voice.connect(channel)
+        # Disarmed as soon as something starts playing
+        self._arm_idle_timer(server)
+        return voice_client
+
+    def _resume_when_connected(self, server):
+        """Reconnects to the queue's channel in the background, the
+            queue_player gets woken up once we're back."""
+        channel = self.bot.get_channel(self.queue[server.id].voice_channel_id)
+        if channel is None:
+            log.debug("sid {} has a queue but no channel to reconnect"
+                      " to".format(server.id))
+            return
+        if not self.voice.reconnecting(server):
+            log.debug("reconnecting sid {} to resume its queue".format(
+                server.id))
+            perf.incr("voice_reconnects")
+        self.voice.reconnect(channel, self._wake_player)
 
     def _list_local_playlists(self):
-        ret = []
-        for thing in os.listdir(self.local_playlist_path):
-            if os.path.isdir(os.path.join(self.local_playlist_path, thing)):
-                ret.append(thing)
+        ret = self.local_library.playlist_names()
         log.debug("local playlists:\n\t{}".format(ret))
         return ret
 
@@ -597,16 +2145,7 @@ class Audio:
             server = server.id
         except:
             pass
-        path = "data/audio/playlists"
-        old_playlists = [f[:-4] for f in os.listdir(path)
-                         if f.endswith(".txt")]
-        path = os.path.join(path, server)
-        if os.path.exists(path):
-            new_playlists = [f[:-4] for f in os.listdir(path)
-                             if f.endswith(".txt")]
-        else:
-            new_playlists = []
-        return list(set(old_playlists + new_playlists))
+        return self.playlist_index.names(server)
 
     def _load_playlist(self, server, name, local=True):
         try:
@@ -614,28 +2153,17 @@ class Audio:
         except:
             pass
 
-        f = "data/audio/playlists"
-        if local:
-            f = os.path.join(f, server, name + ".txt")
-        else:
-            f = os.path.join(f, name + ".txt")
-        kwargs = fileIO(f, 'load')
-
-        kwargs['path'] = f
-        kwargs['main_class'] = self
-        kwargs['name'] = name
-        kwargs['sid'] = server
-
-        return Playlist(**kwargs)
+        return self.playlist_index.load(server, name, local=local)
 
     def _local_playlist_songlist(self, name):
-        dirpath = os.path.join(self.local_playlist_path, name)
-        return os.listdir(dirpath)
+        return self.local_library.songlist(name)
 
     def _make_local_song(self, filename):
         # filename should be playlist_folder/file_name
         folder, song = os.path.split(filename)
-        return Song(name=song, id=filename, title=song, url=filename)
+        track = self.local_library.track(folder, song) or {}
+        return Song(id=filename, title=track.get("title") or song,
+                    url=filename, duration=track.get("duration"))
 
     def _make_playlist(self, author, url, songlist):
         try:
@@ -645,6 +2173,12 @@ class Audio:
 
         return Playlist(author=author, url=url, playlist=songlist)
 
+    def _is_playlist_url(self, url):
+        """Stricter than _match_sc_playlist, which accepts any SC link."""
+        if self._match_yt_playlist(url):
+            return True
+        return self._match_sc_url(url) and "/sets/" in url
+
     def _match_sc_playlist(self, url):
         return self._match_sc_url(url)
 
@@ -675,52 +2209,177 @@ class Audio:
 
     # TODO: _next_songs_in_queue
 
-    async def _parse_playlist(self, url):
+    def _playlist_streamer(self, url):
         if self._match_sc_playlist(url):
-            return await self._parse_sc_playlist(url)
+            entry_url = self._sc_entry_url
         elif self._match_yt_playlist(url):
-            return await self._parse_yt_playlist(url)
-        raise InvalidPlaylist("The given URL is neither a Soundcloud or"
-                              " YouTube playlist.")
-
-    async def _parse_sc_playlist(self, url):
+            entry_url = self._yt_entry_url
+        else:
+            raise InvalidPlaylist("The given URL is neither a Soundcloud or"
+                                  " YouTube playlist.")
+        streamer = PlaylistStreamer(url, self.bot.loop, entry_url)
+        streamer.start()
+        return streamer
+
+    async def _parse_playlist(self, url, progress=None):
+        """Returns the list of song URLs in a playlist.
+
+        progress, if given, is awaited with the running track count while
+            youtube_dl pages through the playlist."""
+        streamer = self._playlist_streamer(url)
         playlist = []
-        d = Downloader(url)
-        d.start()
 
-        while d.is_alive():
-            await asyncio.sleep(0.5)
+        while True:
+            song_url = await streamer.get()
+            if song_url is None:
+                break
+            playlist.append(song_url)
+            if progress is not None:
+                await progress(len(playlist))
 
-        for entry in d.song.entries:
-            if entry["url"][4] != "s":
-                song_url = "https{}".format(entry["url"][4:])
-                playlist.append(song_url)
-            else:
-                playlist.append(entry.url)
+        log.debug("song list:\n\t{}".format(playlist))
 
         return playlist
 
-    async def _parse_yt_playlist(self, url):
-        d = Downloader(url)
-        d.start()
-        playlist = []
+    def _ensure_opus(self, song_id):
+        """True if song_id has a pre-encoded Opus file. Otherwise queues it
+            for encoding so that the next play has it, see
+            _start_opus_encodes. Safe to call from downloader threads."""
+        filename = os.path.join(self.cache_path, song_id)
+        if os.path.isfile(filename + OPUS_EXT):
+            return True
+        if not os.path.isfile(filename) or \
+                os.path.isfile(filename + PARTIAL_EXT):
+            return False
 
-        while d.is_alive():
-            await asyncio.sleep(0.5)
+        with self._opus_lock:
+            if song_id not in self._opus_encoding:
+                self._opus_pending[song_id] = None
+        return False
+
+    def _start_opus_encodes(self):
+        """Hands queued songs to the encoder pool, oldest first.
+
+        Songs that are playing somewhere wait, their playback ffmpeg is
+            already decoding them. At most opus_workers encode at once so
+            a burst of new songs doesn't start an encoder each."""
+        playing = set(self._cache_required_files())
+        use_avconv = self.settings["AVCONV"]
+
+        with self._opus_lock:
+            for song_id in list(self._opus_pending):
+                if len(self._opus_encoding) >= self.opus_workers:
+                    break
+                if song_id in playing:
+                    continue
+                del self._opus_pending[song_id]
+                filename = os.path.join(self.cache_path, song_id)
+                if os.path.isfile(filename + OPUS_EXT) or \
+                        not os.path.isfile(filename):  # Evicted meanwhile
+                    continue
+                self._opus_encoding.add(song_id)
+                self._opus_executor.submit(self._encode_opus, song_id,
+                                           use_avconv)
+
+    def _encode_opus(self, song_id, use_avconv):
+        filename = os.path.join(self.cache_path, song_id)
+        try:
+            encode_opus(filename, filename + OPUS_EXT, use_avconv)
+            log.debug("pre-encoded songid {}".format(song_id))
+        except Exception:
+            log.exception("couldn't pre-encode songid {}".format(song_id))
+        finally:
+            with self._opus_lock:
+                self._opus_encoding.discard(song_id)
+
+    async def _enqueue_playlist(self, server, url, progress=None):
+        """Streams a playlist into the server's queue as it's enumerated.
+
+        The queue_player gets woken up by the first entry, so playback
+            starts long before a big playlist is fully known. Returns the
+            number of songs queued."""
+        streamer = self._playlist_streamer(url)
+        if server.id not in self.queue:
+            self._setup_queue(server)
+        server_queue = self.queue[server.id]
+        count = 0
+
+        while True:
+            song_url = await streamer.get()
+            if song_url is None:
+                break
+            if self.queue.get(server.id) is not server_queue:
+                log.debug("queue for sid {} was reset, no longer streaming"
+                          " {}".format(server.id, url))
+                streamer.cancel()
+                break
+            self._add_to_queue(server, song_url)
+            count += 1
+            if progress is not None:
+                await progress(count)
+
+        return count
 
-        for entry in d.song.entries:
+    def _progress_editor(self, message, text, interval=2):
+        """Returns a progress callback that edits message with
+            text.format(count), at most once every `interval` seconds."""
+        last_edit = time.monotonic()
+
+        async def progress(count):
+            nonlocal last_edit
+            now = time.monotonic()
+            if now - last_edit < interval:
+                return
+            last_edit = now
             try:
-                song_url = "https://www.youtube.com/watch?v={}".format(
-                    entry['id'])
-                playlist.append(song_url)
-            except AttributeError:
-                pass
-            except TypeError:
+                await self.bot.edit_message(message, text.format(count))
+            except discord.HTTPException:
                 pass
 
-        log.debug("song list:\n\t{}".format(playlist))
+        return progress
 
-        return playlist
+    def _resolve_batch(self, urls):
+        """Starts getting the info of every url, returns one future per url
+            in the same order, so results can be consumed as they arrive.
+
+        Duplicates share a future, cached songs resolve right away and the
+            rest go through at most resolve_concurrency Downloaders at once.
+            A future's result is None if its url couldn't be resolved."""
+        futures = {}
+        ret = []
+        for url in urls:
+            if url not in futures:
+                futures[url] = self._resolve_future(url)
+            ret.append(futures[url])
+        return ret
+
+    def _resolve_future(self, url):
+        song = info_cache.get(compact_entry(url)) or \
+            self.playlist_index.cached_song(url)
+        if song is not None:
+            future = asyncio.Future(loop=self.bot.loop)
+            future.set_result(song)
+            return future
+        return self.bot.loop.create_task(self._resolve(url))
+
+    async def _resolve(self, url):
+        with (await self._resolve_semaphore):
+            d = Downloader(url)
+            d.start()
+            await self._wait_for_downloader(d)
+        if d.failed:
+            return None
+        return d.song
+
+    @staticmethod
+    def _sc_entry_url(entry):
+        if entry["url"][4] != "s":
+            return "https{}".format(entry["url"][4:])
+        return entry["url"]
+
+    @staticmethod
+    def _yt_entry_url(entry):
+        return "https://www.youtube.com/watch?v={}".format(entry['id'])
 
     async def _play(self, sid, url):
         """Returns the song object of what's playing"""
@@ -741,30 +2400,44 @@ class Audio:
                             "{}".format(self.bot.command_prefix[0], url))
                 raise
             local = False
+            self.cache_ledger.touch(server.id, song.id)
+            self.play_history.record(compact_entry(song.webpage_url or url))
+            downloader = progressive_download(song.id)
+            if self.settings["OPUS_CACHE"] and downloader is not None:
+                downloader.add_done_callback(
+                    lambda d: d.song and self._ensure_opus(d.song.id))
+            elif self.settings["OPUS_CACHE"]:
+                self._ensure_opus(song.id)
         else:  # Assume local
             try:
                 song = self._make_local_song(url)
                 local = True
+                downloader = None
             except FileNotFoundError:
                 raise
 
-        voice_client = await self._create_ffmpeg_player(server, song.id,
-                                                        local=local)
+        voice_client = await self._create_ffmpeg_player(
+            server, song.id, local=local, downloader=downloader)
         # That ^ creates the audio_player property
 
         voice_client.audio_player.start()
         log.debug("starting player on sid {}".format(server.id))
+        self._disarm_idle_timer(server)
+        perf.incr("songs_played")
 
         return song
 
-    def _play_playlist(self, server, playlist):
+    def _play_playlist(self, server, playlist, mix=False):
         try:
             songlist = playlist.playlist
             name = playlist.name
         except AttributeError:
-            songlist = playlist
+            songlist = list(playlist)
             name = True
 
+        if mix:
+            shuffle(songlist)
+
         log.debug("setting up playlist {} on sid {}".format(name, server.id))
 
         self._stop_player(server)
@@ -777,6 +2450,7 @@ class Audio:
         self._set_queue_playlist(server, name)
         self._set_queue_repeat(server, True)
         self._set_queue(server, songlist)
+        self._wake_player(server)
 
     def _play_local_playlist(self, server, name):
         songlist = self._local_playlist_songlist(name)
@@ -790,8 +2464,7 @@ class Audio:
 
     def _player_count(self):
         count = 0
-        queue = copy.deepcopy(self.queue)
-        for sid in queue:
+        for sid in self.queue:
             server = self.bot.get_server(sid)
             try:
                 vc = self.voice_client(server)
@@ -806,11 +2479,7 @@ class Audio:
             self._playlist_exists_global(name)
 
     def _playlist_exists_global(self, name):
-        f = "data/audio/playlists"
-        f = os.path.join(f, name + ".txt")
-        log.debug('checking for {}'.format(f))
-
-        return fileIO(f, 'check')
+        return self.playlist_index.exists_global(name)
 
     def _playlist_exists_local(self, server, name):
         try:
@@ -818,11 +2487,24 @@ class Audio:
         except AttributeError:
             pass
 
-        f = "data/audio/playlists"
-        f = os.path.join(f, server, name + ".txt")
-        log.debug('checking for {}'.format(f))
+        return self.playlist_index.exists_local(server, name)
+
+    def _remember_playlist_song(self, server, name, song):
+        """Caches the song's metadata in the playlist being played, saved a
+            little later so a playlist isn't rewritten for every song."""
+        playlist = self.playlist_index.loaded(server.id, name)
+        if playlist is None or playlist.path is None or \
+                not playlist.remember(song):
+            return
+        if playlist not in self._playlist_saves:
+            self._playlist_saves[playlist] = self.bot.loop.call_later(
+                60, self._save_remembered, playlist)
 
-        return fileIO(f, 'check')
+    def _save_remembered(self, playlist):
+        self._playlist_saves.pop(playlist, None)
+        # Only the live copy gets written, never over a newer one
+        if not self.playlist_index.replaced(playlist):
+            playlist.save()
 
     def _remove_queue(self, server):
         if server.id in self.queue:
@@ -837,27 +2519,18 @@ class Audio:
             self._old_game = False
 
     def _save_playlist(self, server, name, playlist):
-        sid = server.id
-        try:
-            f = playlist.filename
-            playlist = playlist.to_json()
-            log.debug("got playlist object")
-        except AttributeError:
-            f = os.path.join("data/audio/playlists", sid, name + ".txt")
-
-        head, _ = os.path.split(f)
-        if not os.path.exists(head):
-            os.makedirs(head)
+        playlist.name = name
+        playlist.server = server
 
-        log.debug("saving playlist '{}' to {}:\n\t{}".format(name, f,
-                                                             playlist))
-        fileIO(f, 'save', playlist)
+        log.debug("saving playlist '{}' to {}: {} songs".format(
+            name, playlist.path, len(playlist)))
+        self.playlist_index.save(playlist)
 
     def _shuffle_queue(self, server):
-        shuffle(self.queue[server.id]["QUEUE"])
+        shuffle(self.queue[server.id].queue)
 
     def _shuffle_temp_queue(self, server):
-        shuffle(self.queue[server.id]["TEMP_QUEUE"])
+        shuffle(self.queue[server.id].temp_queue)
 
     def _server_count(self):
         return max([1, len(self.bot.servers)])
@@ -867,7 +2540,7 @@ class Audio:
             self._clear_queue(server)
         else:
             self._setup_queue(server)
-        self.queue[server.id]["QUEUE"].extend(songlist)
+        self.queue[server.id].queue.extend(songlist)
 
     def _set_queue_channel(self, server, channel):
         if server.id not in self.queue:
@@ -878,36 +2551,36 @@ class Audio:
         except AttributeError:
             pass
 
-        self.queue[server.id]["VOICE_CHANNEL_ID"] = channel
+        self.queue[server.id].voice_channel_id = channel
 
     def _set_queue_nowplaying(self, server, song):
         if server.id not in self.queue:
             return
 
-        self.queue[server.id]["NOW_PLAYING"] = song
+        self.queue[server.id].now_playing = song
 
     def _set_queue_playlist(self, server, name=True):
         if server.id not in self.queue:
             self._setup_queue(server)
 
-        self.queue[server.id]["PLAYLIST"] = name
+        self.queue[server.id].playlist = name
 
     def _set_queue_repeat(self, server, value):
         if server.id not in self.queue:
             self._setup_queue(server)
 
-        self.queue[server.id]["REPEAT"] = value
+        self.queue[server.id].repeat = value
 
     def _setup_queue(self, server):
-        self.queue[server.id] = {"REPEAT": False, "PLAYLIST": False,
-                                 "VOICE_CHANNEL_ID": None,
-                                 "QUEUE": deque(), "TEMP_QUEUE": deque(),
-                                 "NOW_PLAYING": None}
+        self.queue[server.id] = ServerQueue()
 
     def _stop(self, server):
         self._setup_queue(server)
+        self._stop_queue_player(server)
         self._stop_player(server)
         self._stop_downloader(server)
+        if self.voice_connected(server):
+            self._arm_idle_timer(server)
         self.bot.loop.create_task(self._update_bot_status())
 
     async def _stop_and_disconnect(self, server):
@@ -920,6 +2593,11 @@ class Audio:
 
         del self.downloaders[server.id]
 
+    def _stop_queue_player(self, server):
+        task = self._players.pop(server.id, None)
+        if task is not None:
+            task.cancel()
+
     def _stop_player(self, server):
         if not self.voice_connected(server):
             return
@@ -940,12 +2618,100 @@ class Audio:
                 return
             if len(active_servers) == 1:
                 server = active_servers[0].server
-                song = self.queue[server.id]["NOW_PLAYING"]
+                song = self.queue[server.id].now_playing
             if song:
                 await self._add_song_status(song)
             else:
                 await self._remove_song_status()
 
+    def _observe_queue_wait(self, server_queue, url):
+        waited = server_queue.pop_queue_wait(url)
+        if waited is not None:
+            perf.observe("queue_wait_seconds", waited)
+
+    def _ffmpeg_process_count(self):
+        """ffmpeg processes alive right now, decoding or pre-encoding."""
+        count = len(self._opus_encoding)
+        for source in list(self._broadcasts.values()):
+            if source.process is not None and source.process.poll() is None:
+                count += 1
+        for vc in self.bot.voice_clients:
+            try:
+                if vc.audio_player.process.poll() is None:
+                    count += 1
+            except AttributeError:
+                pass
+        return count
+
+    def _perf_report(self):
+        data = perf.to_dict()
+        data["gauges"] = {"ffmpeg_processes": self._ffmpeg_process_count(),
+                          "players": self._player_count(),
+                          "player_tasks": len(self._players),
+                          "cache_mb": self._cache_size(),
+                          "cache_max_mb": self._cache_max(),
+                          "cache_min_mb": self._cache_min(),
+                          "search_cache_entries": len(search_cache),
+                          "info_cache_entries": len(info_cache)}
+        return data
+
+    async def _wait_for_downloader(self, downloader):
+        """Waits for a started Downloader without polling is_alive."""
+        loop = self.bot.loop
+        future = asyncio.Future(loop=loop)
+
+        def resolve():
+            if not future.done():
+                future.set_result(downloader)
+
+        downloader.add_done_callback(
+            lambda d: loop.call_soon_threadsafe(resolve))
+        return await future
+
+    async def _wait_until_playable(self, downloader):
+        """Waits for a started Downloader to finish, or for just its first
+            chunk if it's downloading progressively."""
+        if not downloader.progressive:
+            await self._wait_for_downloader(downloader)
+            return
+        loop = self.bot.loop
+        future = asyncio.Future(loop=loop)
+
+        def resolve():
+            if not future.done():
+                future.set_result(downloader)
+
+        downloader.add_ready_callback(
+            lambda d: loop.call_soon_threadsafe(resolve))
+        await future
+
+    def _wake_player(self, server):
+        """Wakes up the server's queue_player, starting it if needed."""
+        try:
+            sid = server.id
+        except AttributeError:
+            sid = server
+
+        if sid not in self._wakeups:
+            self._wakeups[sid] = asyncio.Event(loop=self.bot.loop)
+        self._wakeups[sid].set()
+
+        task = self._players.get(sid)
+        if task is None or task.done():
+            log.debug("starting queue_player for sid {}".format(sid))
+            self._players[sid] = self.bot.loop.create_task(
+                self.queue_player(sid))
+
+    def _player_after(self, sid):
+        """Builds the `after` callback for a server's audio player.
+
+        discord.py calls it from the player thread when the song ends or
+            gets stopped, so we hop back onto the loop to wake up the
+            queue_player."""
+        def after():
+            self.bot.loop.call_soon_threadsafe(self._wake_player, sid)
+        return after
+
     def _valid_playlist_name(self, name):
         for l in name:
             if l.isdigit() or l.isalpha() or l == "_":
@@ -995,6 +2761,109 @@ class Audio:
         await self.bot.say("Maximum length is now {} seconds.".format(length))
         self.save_settings()
 
+    @audioset.command(name="opus")
+    @checks.is_owner()
+    async def audioset_opus(self):
+        """Toggles the pre-encoded Opus cache
+
+        Songs get encoded once after download and are then streamed to
+        Discord without ffmpeg. Volume can't be changed for those songs."""
+        self.settings["OPUS_CACHE"] = not self.settings["OPUS_CACHE"]
+        if self.settings["OPUS_CACHE"]:
+            await self.bot.say("Opus cache enabled. Cached songs will be"
+                               " played without ffmpeg, at a fixed volume.")
+        else:
+            await self.bot.say("Opus cache disabled.")
+        self.save_settings()
+
+    @audioset.command(name="format")
+    @checks.is_owner()
+    async def audioset_format(self, policy: str, bitrate: int=None):
+        """Sets the download format policy: efficient or best
+
+        efficient prefers small Opus/WebM audio-only formats at or below
+        the target bitrate (kbps), best downloads the best audio there is."""
+        policy = policy.lower()
+        if policy not in FORMAT_POLICIES:
+            await self.bot.say("Policy must be one of: {}".format(
+                ", ".join(sorted(FORMAT_POLICIES))))
+            return
+        if bitrate is not None:
+            if bitrate <= 0:
+                await self.bot.say("Bitrate must be positive.")
+                return
+            self.settings["TARGET_ABR"] = bitrate
+        self.settings["FORMAT_POLICY"] = policy
+        if policy == "efficient":
+            await self.bot.say("Downloads will prefer audio-only formats up to"
+                               " {} kbps.".format(self.settings["TARGET_ABR"]))
+        else:
+            await self.bot.say("Downloads will use the best audio available.")
+        self.save_settings()
+
+    @audioset.command(name="progressive")
+    @checks.is_owner()
+    async def audioset_progressive(self):
+        """Toggles playing songs while they're still downloading"""
+        self.settings["PROGRESSIVE"] = not self.settings["PROGRESSIVE"]
+        if self.settings["PROGRESSIVE"]:
+            await self.bot.say("Songs will start playing as soon as their"
+                               " first chunk is downloaded.")
+        else:
+            await self.bot.say("Songs will be fully downloaded before they"
+                               " play.")
+        self.save_settings()
+
+    @audioset.command(name="warmup")
+    @checks.is_owner()
+    async def audioset_warmup(self, budget_mb: int=None):
+        """Toggles warming the cache with popular songs, or sets its budget
+
+        Runs after startup and then once a day in the warm-up hours."""
+        if budget_mb is not None:
+            if budget_mb <= 0:
+                await self.bot.say("The budget must be positive.")
+                return
+            self.settings["WARMUP_BUDGET"] = budget_mb
+            self.settings["WARMUP"] = True
+        else:
+            self.settings["WARMUP"] = not self.settings["WARMUP"]
+        if self.settings["WARMUP"]:
+            start, end = self.settings["WARMUP_HOURS"]
+            await self.bot.say("Up to {} MB of popular songs will be kept"
+                               " cached, downloaded between {}:00 and {}:00."
+                               "".format(self.settings["WARMUP_BUDGET"],
+                                         start, end))
+        else:
+            await self.bot.say("Cache warm-up disabled.")
+        self.save_settings()
+
+    @audioset.command(name="warmuphours")
+    @checks.is_owner()
+    async def audioset_warmuphours(self, start: int, end: int):
+        """Sets the off-peak hours (0-23, local time) to warm the cache in"""
+        if not (0 <= start <= 23 and 0 <= end <= 23) or start == end:
+            await self.bot.say("Hours must be two different values between"
+                               " 0 and 23.")
+            return
+        self.settings["WARMUP_HOURS"] = [start, end]
+        await self.bot.say("The cache will be warmed between {}:00 and"
+                           " {}:00.".format(start, end))
+        self.save_settings()
+
+    @audioset.command(name="shared")
+    @checks.is_owner()
+    async def audioset_shared(self):
+        """Toggles sharing one decoder between servers playing a song"""
+        self.settings["SHARED_DECODE"] = not self.settings["SHARED_DECODE"]
+        if self.settings["SHARED_DECODE"]:
+            await self.bot.say("Servers starting the same song within 30"
+                               " seconds of each other will now share one"
+                               " decoder.")
+        else:
+            await self.bot.say("Every server gets its own decoder again.")
+        self.save_settings()
+
     @audioset.command(name="player")
     @checks.is_owner()
     async def audioset_player(self):
@@ -1038,8 +2907,6 @@ class Audio:
             vc = self.voice_client(server)
             if vc:
                 vc.audio_player.volume = percent / 100
-
-            self.save_settings()
         else:
             msg = "Volume must be between 0 and 100."
         await self.bot.say(msg)
@@ -1065,7 +2932,6 @@ class Audio:
 
         self.set_server_setting(server, "VOTE_THRESHOLD", percent)
         self.set_server_setting(server, "VOTE_ENABLED", enabled)
-        self.save_settings()
 
     @commands.group(pass_context=True)
     async def audiostat(self, ctx):
@@ -1074,6 +2940,59 @@ class Audio:
             await send_cmd_help(ctx)
             return
 
+    @audiostat.command(name="perf")
+    @checks.is_owner()
+    async def audiostat_perf(self, fmt: str=None):
+        """Audio pipeline metrics. `json` for a machine-readable dump"""
+        data = self._perf_report()
+
+        if fmt == "json":
+            path = "data/audio/perf.json"
+            fileIO(path, "save", data)
+            with open(path, "rb") as f:
+                await self.bot.upload(f, filename="perf.json")
+            return
+
+        def pct(ratio):
+            return "n/a" if ratio is None else "{:.1%}".format(ratio)
+
+        def secs(value):
+            return "n/a" if value is None else "{:.2f}s".format(value)
+
+        counters = data["counters"]
+        gauges = data["gauges"]
+        lines = [
+            "Since {:.0f} minutes ago".format(data["uptime"] / 60),
+            "Cache hits: {} / misses: {} ({})".format(
+                counters.get("cache_hits", 0),
+                counters.get("cache_misses", 0),
+                pct(perf.ratio("cache_hits", "cache_misses"))),
+            "Search cache: {}, info cache: {}".format(
+                pct(perf.ratio("search_cache_hits", "search_cache_misses")),
+                pct(perf.ratio("info_cache_hits", "info_cache_misses"))),
+            "Cache: {:.1f} MB (min {:.1f}, max {:.1f})".format(
+                gauges["cache_mb"], gauges["cache_min_mb"],
+                gauges["cache_max_mb"]),
+            "Songs played: {}, skips: {}".format(
+                counters.get("songs_played", 0), counters.get("skips", 0)),
+            "ffmpeg running: {}, spawned: {}".format(
+                gauges["ffmpeg_processes"],
+                counters.get("ffmpeg_spawned", 0)),
+            ""]
+        for name in sorted(perf.HISTOGRAMS):
+            h = data["histograms"][name]
+            if name.endswith("_bytes"):
+                mean = "n/a" if h["mean"] is None else \
+                    "{:.2f} MB".format(h["mean"] / 2**20)
+                lines.append("{}: n={} mean={}".format(name, h["count"],
+                                                       mean))
+                continue
+            lines.append("{}: n={} mean={} p50<={} p95<={} max={}".format(
+                name, h["count"], secs(h["mean"]), secs(h["p50"]),
+                secs(h["p95"]), secs(h["max"])))
+
+        await self.bot.say("```\n{}\n```".format("\n".join(lines)))
+
     @audiostat.command(name="servers")
     async def audiostat_servers(self):
         """Number of servers currently playing."""
@@ -1090,6 +3009,14 @@ class Audio:
             await send_cmd_help(ctx)
             return
 
+    @cache.command(name="warm")
+    @checks.is_owner()
+    async def cache_warm(self):
+        """Pre-downloads popular songs now, within the warm-up budget."""
+        await self.bot.say("Warming up the cache, this can take a while...")
+        downloaded = await self._warm_cache()
+        await self.bot.say("Done, downloaded {} songs.".format(downloaded))
+
     @cache.command(name="dump")
     @checks.is_owner()
     async def cache_dump(self):
@@ -1109,6 +3036,18 @@ class Audio:
         await self.bot.say("Cache is currently at {:.3f} MB.".format(
             self._cache_size()))
 
+    @cache.command(pass_context=True, no_pm=True, name="usage")
+    async def cache_usage(self, ctx):
+        """This server's share of the cache."""
+        sizes = self._cache_song_sizes(self._cache_songs())
+        usage = self.cache_ledger.usage(sizes)
+        servers = len([sid for sid in usage if sid is not None]) or 1
+        await self.bot.say(
+            "This server uses {:.3f} MB of the cache. Its fair share is"
+            " {:.3f} MB, beyond that its least recently played songs are"
+            " the first to go.".format(usage[ctx.message.server.id],
+                                       self._cache_max() / servers))
+
     @commands.group(pass_context=True, hidden=True, no_pm=True)
     @checks.is_owner()
     async def disconnect(self, ctx):
@@ -1209,6 +3148,17 @@ class Audio:
         else:
             await self.bot.say("There are no playlists.")
 
+    @local.command(name="search", no_pm=True)
+    async def search_local(self, *, terms):
+        """Searches local tracks by title"""
+        found = self.local_library.search(terms)
+        if found:
+            msg = "\n".join("{}: {}".format(playlist, title)
+                            for playlist, _, title in found)
+            await self.bot.say("```xl\n{}```".format(msg))
+        else:
+            await self.bot.say("No local tracks match that.")
+
     @commands.command(pass_context=True, no_pm=True)
     async def pause(self, ctx):
         """Pauses the current song, `[p]resume` to continue."""
@@ -1286,6 +3236,20 @@ class Audio:
 
         self._stop_player(server)
         self._clear_queue(server)
+        if server.id not in self.queue:
+            self._setup_queue(server)
+        self.queue[server.id].requested_at = time.monotonic()
+
+        if self._is_playlist_url(url):
+            # First track starts as soon as it's enumerated
+            status = await self.bot.say("Queueing playlist...")
+            progress = self._progress_editor(
+                status, "Queueing playlist... {} tracks so far.")
+            count = await self._enqueue_playlist(server, url, progress)
+            await self.bot.edit_message(
+                status, "Queued {} tracks.".format(count))
+            return
+
         self._add_to_queue(server, url)
 
     @commands.command(pass_context=True, no_pm=True)
@@ -1300,7 +3264,7 @@ class Audio:
             if self._is_queue_playlist(server):
                 # need to reorder queue
                 try:
-                    last_url = self.queue[server.id]["QUEUE"].pop()
+                    last_url = self.queue[server.id].queue.pop()
                 except IndexError:
                     pass
 
@@ -1359,9 +3323,11 @@ class Audio:
 
         if self._valid_playable_url(url):
             try:
-                await self.bot.say("Enumerating song list... This could take"
-                                   " a few moments.")
-                songlist = await self._parse_playlist(url)
+                status = await self.bot.say("Enumerating song list... This"
+                                            " could take a few moments.")
+                progress = self._progress_editor(
+                    status, "Enumerating song list... {} tracks so far.")
+                songlist = await self._parse_playlist(url, progress)
             except InvalidPlaylist:
                 await self.bot.say("That playlist URL is invalid.")
                 return
@@ -1401,10 +3367,54 @@ class Audio:
             await self.bot.say("Done.")
 
     @playlist.command(pass_context=True, no_pm=True, name="extend")
-    async def playlist_extend(self, ctx, playlist_url_or_name):
-        """Extends a playlist with a playlist link"""
-        # Need better wording ^
-        await self.bot.say("Not implemented yet.")
+    async def playlist_extend(self, ctx, name, playlist_url_or_name):
+        """Extends a playlist with a playlist link or another playlist"""
+        server = ctx.message.server
+        author = ctx.message.author
+        source = playlist_url_or_name
+
+        if not self._playlist_exists(server, name):
+            await self.bot.say("There is no playlist with that name.")
+            return
+        playlist = self._load_playlist(
+            server, name, local=self._playlist_exists_local(server, name))
+        if author.id != playlist.author:
+            await self.bot.say("You're not the author of that playlist.")
+            return
+
+        status = await self.bot.say("Enumerating song list... This could"
+                                    " take a few moments.")
+        if self._is_playlist_url(source):
+            progress = self._progress_editor(
+                status, "Enumerating song list... {} tracks so far.")
+            songlist = await self._parse_playlist(source, progress)
+        elif self._playlist_exists(server, source):
+            songlist = self._load_playlist(
+                server, source,
+                local=self._playlist_exists_local(server, source)).playlist
+        else:
+            await self.bot.edit_message(
+                status, "That's neither a playlist link nor a saved"
+                        " playlist.")
+            return
+
+        progress = self._progress_editor(
+            status, "Checking songs... {}/" + str(len(songlist)))
+        added = 0
+        futures = self._resolve_batch(songlist)
+        for num, (url, future) in enumerate(zip(songlist, futures), 1):
+            song = await future
+            await progress(num)
+            if song is None:
+                continue
+            playlist.entries.append(compact_entry(url))
+            playlist.remember(song)
+            added += 1
+
+        playlist.save()
+        await self.bot.edit_message(
+            status, "Added {} songs to '{}'. {} couldn't be found.".format(
+                added, name, len(songlist) - added))
 
     @playlist.command(pass_context=True, no_pm=True, name="list")
     async def playlist_list(self, ctx):
@@ -1421,11 +3431,14 @@ class Audio:
             await self.bot.say("There are no playlists.")
 
     @playlist.command(pass_context=True, no_pm=True, name="queue")
-    async def playlist_queue(self, ctx, url):
-        """Adds a song to the playlist loop.
+    async def playlist_queue(self, ctx, *urls):
+        """Adds songs or playlist links to the playlist loop.
 
         Does NOT write to disk."""
         server = ctx.message.server
+        if not urls:
+            await send_cmd_help(ctx)
+            return
         if not self.voice_connected(server):
             await self.bot.say("Not voice connected in this server.")
             return
@@ -1439,9 +3452,29 @@ class Audio:
                                     " happen.")
 
         # We have a queue to modify
-        self._add_to_queue(server, url)
+        songs = [url for url in urls if not self._is_playlist_url(url)]
+        resolved = dict(zip(songs, self._resolve_batch(songs)))
+        status = await self.bot.say("Queueing...")
+        progress = self._progress_editor(status,
+                                         "Queueing... {} tracks so far.")
+        count = 0
+        failed = 0
 
-        await self.bot.say("Queued.")
+        for url in urls:
+            if url in resolved:
+                if await resolved[url] is None:
+                    failed += 1
+                    continue
+                self._add_to_queue(server, url)
+                count += 1
+            else:
+                count += await self._enqueue_playlist(server, url)
+            await progress(count)
+
+        msg = "Queued {} tracks.".format(count)
+        if failed:
+            msg += " {} links couldn't be found.".format(failed)
+        await self.bot.edit_message(status, msg)
 
     @playlist.command(pass_context=True, no_pm=True, name="remove")
     async def playlist_remove(self, ctx, name):
@@ -1495,10 +3528,8 @@ class Audio:
             playlist = self._load_playlist(server, name,
                                            local=self._playlist_exists_local(
                                                server, name))
-            if caller == "playlist_start_mix":
-                shuffle(playlist.playlist)
-
-            self._play_playlist(server, playlist)
+            self._play_playlist(server, playlist,
+                                mix=caller == "playlist_start_mix")
             await self.bot.say("Playlist queued.")
         else:
             await self.bot.say("That playlist does not exist.")
@@ -1542,7 +3573,7 @@ class Audio:
             url = url.split("&")[0] # Temp fix for the &list issue
 
         # We have a queue to modify
-        if self.queue[server.id]["PLAYLIST"]:
+        if self.queue[server.id].playlist:
             log.debug("queueing to the temp_queue for sid {}".format(
                 server.id))
             self._add_to_temp_queue(server, url)
@@ -1558,7 +3589,7 @@ class Audio:
         if server.id not in self.queue:
             await self.bot.say("Nothing playing on this server!")
             return
-        elif len(self.queue[server.id]["QUEUE"]) == 0:
+        elif len(self.queue[server.id].queue) == 0:
             await self.bot.say("Nothing queued on this server.")
             return
 
@@ -1601,7 +3632,7 @@ class Audio:
         server = ctx.message.server
         if ctx.invoked_subcommand is None:
             if self.is_playing(server):
-                if self.queue[server.id]["REPEAT"]:
+                if self.queue[server.id].repeat:
                     msg = "The queue is currently looping."
                 else:
                     msg = "The queue is currently not looping."
@@ -1619,8 +3650,8 @@ class Audio:
                                " Try playing something first.")
             return
 
-        self._set_queue_repeat(server, not self.queue[server.id]["REPEAT"])
-        repeat = self.queue[server.id]["REPEAT"]
+        self._set_queue_repeat(server, not self.queue[server.id].repeat)
+        repeat = self.queue[server.id].repeat
         if repeat:
             await self.bot.say("Repeat toggled on.")
         else:
@@ -1671,6 +3702,7 @@ class Audio:
             vc = self.voice_client(server)
             if msg.author.voice_channel == vchan:
                 if self.can_instaskip(msg.author):
+                    perf.incr("skips")
                     vc.audio_player.stop()
                     if self._get_queue_repeat(server) is False:
                         self._set_queue_nowplaying(server, None)
@@ -1690,6 +3722,7 @@ class Audio:
                     thresh = self.get_server_settings(server)["VOTE_THRESHOLD"]
 
                     if vote >= thresh:
+                        perf.incr("skips")
                         vc.audio_player.stop()
                         if self._get_queue_repeat(server) is False:
                             self._set_queue_nowplaying(server, None)
@@ -1741,13 +3774,7 @@ class Audio:
 
         song = self._get_queue_nowplaying(server)
         if song:
-            if not hasattr(song, 'creator'):
-                song.creator = None
-            if not hasattr(song, 'view_count'):
-                song.view_count = None
-            if not hasattr(song, 'uploader'):
-                song.uploader = None
-            if hasattr(song, 'duration'):
+            if song.duration:
                 m, s = divmod(song.duration, 60)
                 dur = "{:.0f}:{:.0f}".format(m, s)
             else:
@@ -1797,9 +3824,13 @@ class Audio:
         while self == self.bot.get_cog("Audio"):
             if self._cache_too_large():
                 # Our cache is too big, dumping
-                log.debug("cache too large ({} > {}), dumping".format(
+                log.debug("cache too large ({} > {}), evicting".format(
                     self._cache_size(), self._cache_max()))
-                self._dump_cache()
+                self._evict_cache()
+            if self._opus_pending:
+                self._start_opus_encodes()
+            self.cache_ledger.save(min_interval=60)
+            self.play_history.save(min_interval=60)
             await asyncio.sleep(5)  # No need to run this every half second
 
     async def cache_scheduler(self):
@@ -1807,64 +3838,133 @@ class Audio:
 
         self.bot.loop.create_task(self.cache_manager())
 
+    def _in_warmup_hours(self, hour):
+        start, end = self.settings["WARMUP_HOURS"]
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end  # Window wraps past midnight
+
+    def _warmup_candidates(self, plays, playlists):
+        """YouTube ids to pre-download, most popular first.
+
+        A recent play counts 1 and being in a saved playlist a little, so
+            songs nobody played yet still rank by how many playlists have
+            them. Takes copies made on the event loop, plays from
+            PlayHistory.scores and playlists from PlaylistIndex.scan, and
+            reads every playlist file, so run it in an executor."""
+        scores = collections.Counter()
+        for entry, score in plays.items():
+            if YT_ID.match(entry):
+                scores[entry] += score
+        for sid, name, entries in PlaylistIndex.read_entries(playlists):
+            for entry in set(entries):
+                if YT_ID.match(entry):
+                    scores[entry] += self.warmup_playlist_weight
+        return [entry for entry, score in scores.most_common()]
+
+    async def _warm_cache(self):
+        """Pre-downloads the most popular songs until WARMUP_BUDGET MB of
+            them are cached, one at a time. Returns how many it downloaded."""
+        if self._warming:
+            return 0
+        self._warming = True
+        budget = min(self.settings["WARMUP_BUDGET"], self._cache_max() / 2)
+        used = 0
+        downloaded = 0
+
+        try:
+            candidates = await self.bot.loop.run_in_executor(
+                None, self._warmup_candidates, self.play_history.scores(),
+                self.playlist_index.scan())
+            for song_id in candidates:
+                if used >= budget or self != self.bot.get_cog("Audio"):
+                    break
+                filename = os.path.join(self.cache_path, song_id)
+                if not os.path.isfile(filename) or \
+                        os.path.isfile(filename + PARTIAL_EXT):
+                    d = self._make_downloader(expand_entry(song_id),
+                                              download=True)
+                    d.start()
+                    await self._wait_for_downloader(d)
+                    if not os.path.isfile(filename):  # Failed or too long
+                        continue
+                    downloaded += 1
+                    perf.incr("warmup_downloads")
+                    await asyncio.sleep(self.warmup_delay)
+                try:
+                    used += os.path.getsize(filename) / 10**6
+                except OSError:
+                    continue
+                self._warmed.add(song_id)
+        finally:
+            self._warming = False
+
+        log.debug("warm-up downloaded {} songs, {:.1f} MB of popular songs"
+                  " cached".format(downloaded, used))
+        return downloaded
+
+    async def warmup_scheduler(self):
+        """Warms the cache once after startup, then once a day during
+            WARMUP_HOURS, while WARMUP is enabled."""
+        await asyncio.sleep(60)  # Let the bot settle first
+        warmed_on = None  # date of the last off-peak warm-up
+        started = False
+
+        while self == self.bot.get_cog("Audio"):
+            if self.settings["WARMUP"]:
+                now = datetime.datetime.now()
+                off_peak = self._in_warmup_hours(now.hour)
+                if not started or (off_peak and warmed_on != now.date()):
+                    started = True
+                    if off_peak:
+                        warmed_on = now.date()
+                    try:
+                        await self._warm_cache()
+                    except Exception:
+                        log.exception("cache warm-up failed")
+            await asyncio.sleep(600)
+
     def currently_downloading(self, server):
         if server.id in self.downloaders:
             if self.downloaders[server.id].is_alive():
                 return True
         return False
 
-    async def disconnect_timer(self):
-        stop_times = {}
-        while self == self.bot.get_cog('Audio'):
-            for vc in self.bot.voice_clients:
-                server = vc.server
-                if not hasattr(vc, 'audio_player') and \
-                        (server not in stop_times or
-                         stop_times[server] is None):
-                    log.debug("putting sid {} in stop loop, no player".format(
-                        server.id))
-                    stop_times[server] = int(time.time())
-
-                if hasattr(vc, 'audio_player'):
-                    if vc.audio_player.is_done() and \
-                            (server not in stop_times or
-                             stop_times[server] is None):
-                        log.debug("putting sid {} in stop loop".format(
-                            server.id))
-                        stop_times[server] = int(time.time())
-                    elif vc.audio_player.is_playing():
-                        stop_times[server] = None
-
-            for server in stop_times:
-                if stop_times[server] and \
-                        int(time.time()) - stop_times[server] > 300:
-                    # 5 min not playing to d/c
-                    log.debug("dcing from sid {} after 300s".format(server.id))
-                    await self._disconnect_voice_client(server)
-                    stop_times[server] = None
-            await asyncio.sleep(5)
+    def _arm_idle_timer(self, server):
+        """Disconnects from server after idle_timeout seconds, unless
+            _disarm_idle_timer gets called first."""
+        self._disarm_idle_timer(server)
+        log.debug("sid {} idle, disconnecting in {}s".format(
+            server.id, self.idle_timeout))
+        self._idle_timers[server.id] = self.bot.loop.call_later(
+            self.idle_timeout,
+            lambda: self.bot.loop.create_task(self._idle_disconnect(server)))
+
+    def _disarm_idle_timer(self, server):
+        timer = self._idle_timers.pop(server.id, None)
+        if timer is not None:
+            timer.cancel()
+
+    async def _idle_disconnect(self, server):
+        self._idle_timers.pop(server.id, None)
+        if self.is_playing(server):
+            return
+        log.debug("dcing from sid {} after {}s".format(server.id,
+                                                       self.idle_timeout))
+        await self._disconnect_voice_client(server)
 
     def get_server_settings(self, server):
+        """Read-only as far as the disk is concerned, it's called for every
+            voice member on skip votes."""
         try:
             sid = server.id
         except:
             sid = server
 
         if sid not in self.settings["SERVERS"]:
-            self.settings["SERVERS"][sid] = {}
-        ret = self.settings["SERVERS"][sid]
-
-        for setting in self.server_specific_setting_keys:
-            if setting not in ret:
-                # Add the default
-                ret[setting] = self.settings[setting]
-                if setting.lower() == "volume" and ret[setting] <= 1:
-                    ret[setting] *= 100
-        # ^This will make it so that only users with an outdated config will
-        # have their volume set * 100. In theory.
-        self.save_settings()
+            self._fill_server_settings(sid)
 
-        return ret
+        return self.settings["SERVERS"][sid]
 
     def has_connect_perm(self, author, server):
         channel = author.voice_channel
@@ -1879,22 +3979,24 @@ class Audio:
         return False
 
     async def queue_manager(self, sid):
-        """This function assumes that there's something in the queue for us to
-            play"""
+        """Starts the next song if we're not playing, then makes sure the
+            song after that is being downloaded."""
         server = self.bot.get_server(sid)
-        max_length = self.settings["MAX_LENGTH"]
 
         # This is a reference, or should be at least
-        temp_queue = self.queue[server.id]["TEMP_QUEUE"]
-        queue = self.queue[server.id]["QUEUE"]
-        repeat = self.queue[server.id]["REPEAT"]
-        last_song = self.queue[server.id]["NOW_PLAYING"]
-
-        assert temp_queue is self.queue[server.id]["TEMP_QUEUE"]
-        assert queue is self.queue[server.id]["QUEUE"]
+        server_queue = self.queue[server.id]
+        temp_queue = server_queue.temp_queue
+        queue = server_queue.queue
+        repeat = server_queue.repeat
+        last_song = server_queue.now_playing
 
         # _play handles creating the voice_client and player for us
 
+        if not self.is_playing(server) and len(server_queue) > 0 and \
+                not self.voice_connected(server):
+            self._resume_when_connected(server)
+            return
+
         if not self.is_playing(server):
             log.debug("not playing anything on sid {}".format(server.id) +
                       ", attempting to start a new song.")
@@ -1902,12 +4004,15 @@ class Audio:
             if len(temp_queue) > 0:
                 # Fake queue for irdumb's temp playlist songs
                 log.debug("calling _play because temp_queue is non-empty")
+                url = temp_queue.popleft()
+                self._observe_queue_wait(server_queue, url)
                 try:
-                    song = await self._play(sid, temp_queue.popleft())
+                    song = await self._play(sid, url)
                 except MaximumLength:
                     return
             elif len(queue) > 0:  # We're in the normal queue
                 url = queue.popleft()
+                self._observe_queue_wait(server_queue, url)
                 log.debug("calling _play on the normal queue")
                 try:
                     song = await self._play(sid, url)
@@ -1917,43 +4022,71 @@ class Audio:
                     queue.append(last_song.webpage_url)
             else:
                 song = None
-            self.queue[server.id]["NOW_PLAYING"] = song
+            server_queue.now_playing = song
             log.debug("set now_playing for sid {}".format(server.id))
+            if song is not None and isinstance(server_queue.playlist, str):
+                self._remember_playlist_song(server, server_queue.playlist,
+                                             song)
+            if song is not None and server_queue.requested_at is not None:
+                perf.observe("time_to_audio_seconds",
+                             time.monotonic() - server_queue.requested_at)
+                server_queue.requested_at = None
             self.bot.loop.create_task(self._update_bot_status())
 
-        elif server.id in self.downloaders:
+        if self.is_playing(server) and server.id in self.downloaders:
             # We're playing but we might be able to download a new song
+            max_length = self.settings["MAX_LENGTH"]
             curr_dl = self.downloaders.get(server.id)
-            if len(temp_queue) > 0:
-                next_dl = Downloader(temp_queue.peekleft(),
-                                     max_length)
-            elif len(queue) > 0:
-                next_dl = Downloader(queue.peekleft(), max_length)
-            else:
-                next_dl = None
-
-            if next_dl is not None:
+            next_url = server_queue.next_url()
+            if next_url is not None:
+                next_dl = Downloader(next_url, max_length)
                 # Download next song
                 next_dl.start()
                 await self._download_next(server, curr_dl, next_dl)
 
-    async def queue_scheduler(self):
-        while self == self.bot.get_cog('Audio'):
-            tasks = []
-            queue = copy.deepcopy(self.queue)
-            for sid in queue:
-                if len(queue[sid]["QUEUE"]) == 0 and \
-                        len(queue[sid]["TEMP_QUEUE"]) == 0:
-                    continue
-                # log.debug("scheduler found a non-empty queue"
-                #           " for sid: {}".format(sid))
-                tasks.append(
-                    self.bot.loop.create_task(self.queue_manager(sid)))
-            completed = [t.done() for t in tasks]
-            while not all(completed):
-                completed = [t.done() for t in tasks]
-                await asyncio.sleep(0.5)
-            await asyncio.sleep(1)
+    async def queue_player(self, sid):
+        """Per-server player task, replaces polling every queue each second.
+
+        It sleeps until it's woken up by an enqueue, a skip, the player's
+            `after` callback or a stop, and exits once the server is idle so
+            that idle servers cost nothing. _wake_player restarts it."""
+        wakeup = self._wakeups[sid]
+        try:
+            while self == self.bot.get_cog('Audio'):
+                wakeup.clear()
+                server = self.bot.get_server(sid)
+                if server is None or sid not in self.queue:
+                    break
+
+                try:
+                    await self.queue_manager(sid)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.exception("queue_manager failed on sid {}".format(
+                        sid))
+
+                if sid not in self.queue:
+                    break
+                queued = len(self.queue[sid]) > 0
+                if not self.is_playing(server):
+                    if queued and self.voice_connected(server):
+                        # The song we popped didn't start, try the next one
+                        continue
+                    if queued:
+                        # The VoiceManager wakes us up once we're back
+                        self._resume_when_connected(server)
+                        break
+                    log.debug("queue_player for sid {} is idle".format(sid))
+                    if self.voice_connected(server):
+                        self._arm_idle_timer(server)
+                    break
+
+                await wakeup.wait()
+        finally:
+            if self._players.get(sid) is asyncio.Task.current_task(
+                    loop=self.bot.loop):
+                del self._players[sid]
 
     async def reload_monitor(self):
         while self == self.bot.get_cog('Audio'):
@@ -1966,12 +4099,44 @@ class Audio:
                 pass
 
     def save_settings(self):
-        fileIO('data/audio/settings.json', 'save', self.settings)
+        """Marks the settings as changed and schedules a save.
+
+        Changes made within settings_save_delay seconds of each other end up
+            in a single write."""
+        self._settings_dirty = True
+        if self._settings_save is None:
+            self._settings_save = self.bot.loop.call_later(
+                self.settings_save_delay, self._flush_settings)
 
     def set_server_setting(self, server, key, value):
-        if server.id not in self.settings["SERVERS"]:
-            self.settings["SERVERS"][server.id] = {}
-        self.settings["SERVERS"][server.id][key] = value
+        settings = self.get_server_settings(server)
+        if settings.get(key) != value:
+            settings[key] = value
+            self.save_settings()
+
+    def _fill_server_settings(self, sid):
+        """Adds the missing server specific keys with their defaults.
+
+        Only done once per server, on load or on first use."""
+        ret = self.settings["SERVERS"].setdefault(sid, {})
+
+        for setting in self.server_specific_setting_keys:
+            if setting not in ret:
+                # Add the default
+                ret[setting] = self.settings[setting]
+                if setting.lower() == "volume" and ret[setting] <= 1:
+                    ret[setting] *= 100
+        # ^This will make it so that only users with an outdated config will
+        # have their volume set * 100. In theory.
+        return ret
+
+    def _flush_settings(self):
+        if self._settings_save is not None:
+            self._settings_save.cancel()
+            self._settings_save = None
+        if self._settings_dirty:
+            self._settings_dirty = False
+            fileIO('data/audio/settings.json', 'save', self.settings)
 
     def voice_client(self, server):
         return self.bot.voice_client_in(server)
@@ -2025,7 +4190,10 @@ def check_files():
     default = {"VOLUME": 50, "MAX_LENGTH": 3700, "VOTE_ENABLED": True,
                "MAX_CACHE": 0, "SOUNDCLOUD_CLIENT_ID": None,
                "TITLE_STATUS": True, "AVCONV": False, "VOTE_THRESHOLD": 50,
-               "SERVERS": {}}
+               "OPUS_CACHE": False, "SHARED_DECODE": False,
+               "FORMAT_POLICY": "efficient", "TARGET_ABR": 96,
+               "PROGRESSIVE": False, "WARMUP": False, "WARMUP_BUDGET": 500,
+               "WARMUP_HOURS": [3, 7], "SERVERS": {}}
     settings_path = "data/audio/settings.json"
 
     if not os.path.isfile(settings_path):
@@ -2064,7 +4232,6 @@ def setup(bot):
     n = Audio(bot)  # Praise 26
     bot.add_cog(n)
     bot.add_listener(n.voice_state_update, 'on_voice_state_update')
-    bot.loop.create_task(n.queue_scheduler())
-    bot.loop.create_task(n.disconnect_timer())
     bot.loop.create_task(n.reload_monitor())
     bot.loop.create_task(n.cache_scheduler())
+    bot.loop.create_task(n.warmup_scheduler())
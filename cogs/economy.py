@@ -1,16 +1,30 @@
 import discord
 from discord.ext import commands
+import aiohttp
+import asyncio
 from cogs.utils.dataIO import dataIO
 from collections import namedtuple, defaultdict
+from contextlib import contextmanager
 from datetime import datetime
-from random import randint
-from copy import deepcopy
+from random import randrange
+from bisect import bisect_left, insort
 from .utils import checks
 from __main__ import send_cmd_help
 import os
+import io
+import csv
+import json
+import math
 import time
 import logging
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
 default_settings = {"PAYDAY_TIME" : 300, "PAYDAY_CREDITS" : 120, "SLOT_MIN" : 5, "SLOT_MAX" : 100, "SLOT_TIME" : 0}
 
 slot_payouts = """Slot machine payouts:
@@ -48,27 +62,307 @@ class SameSenderAndReceiver(BankError):
     pass
 
 
+Account = namedtuple("Account", "id name balance created_at server member")
+LedgerEntry = namedtuple("LedgerEntry", "timestamp kind server_id user_id "
+                         "balance delta extra")
+
+
+class AccountRecord:
+    """An account as the bank keeps it in memory
+
+    Never handed out, callers get Account views instead."""
+    __slots__ = ("id", "name", "balance", "created_at")
+
+    def __init__(self, id, name, balance, created_at):
+        self.id = id
+        self.name = name
+        self.balance = balance
+        self.created_at = created_at
+
+    @classmethod
+    def from_dict(cls, user_id, data):
+        created_at = datetime.strptime(data["created_at"], DATE_FORMAT)
+        return cls(user_id, data["name"], data["balance"], created_at)
+
+    def to_dict(self):
+        return {"name" : self.name,
+                "balance" : self.balance,
+                "created_at" : self.created_at.strftime(DATE_FORMAT)
+               }
+
+
+class Leaderboard:
+    """Keys kept sorted, highest balance first
+
+    Keys are tuples starting with the negated balance, so a balance change
+    is one removal and one insertion instead of a sort of every account."""
+
+    def __init__(self, keys=()):
+        self._keys = sorted(keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def add(self, key):
+        insort(self._keys, key)
+
+    def remove(self, key):
+        i = bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def replace(self, old_key, new_key):
+        self.remove(old_key)
+        self.add(new_key)
+
+
+class Ledger:
+    """Append-only log of every change made to the bank
+
+    One JSON array per line: [timestamp, kind, server id, user id,
+    balance, delta, extra]. The balance is the one after the change, so
+    replaying a part of the log that's already applied changes nothing.
+    Once a snapshot covers the file, rotate() moves it to <path>.<n>, and
+    the last keep_segments of those are kept for bank history."""
+
+    def __init__(self, path, keep_segments=8, max_history=100):
+        self.path = path
+        self.keep_segments = keep_segments
+        self.max_history = max_history # Lines indexed per account
+        self._repair()
+        self.segments = self._find_segments() # Rotated ones, oldest first
+        # The number the active file gets once rotated
+        self.segment = self.segments[-1] + 1 if self.segments else 1
+        self._file = open(path, "ab")
+        self._index = None # (server id, user id): [(segment, offset)]
+
+    @property
+    def size(self):
+        return self._file.tell()
+
+    @property
+    def indexed(self):
+        return self._index is not None
+
+    def segment_path(self, segment):
+        if segment == self.segment:
+            return self.path
+        return "{}.{}".format(self.path, segment)
+
+    def files(self):
+        """(segment, path) of every file kept, oldest first"""
+        return [(s, self.segment_path(s)) for s in self.segments + [self.segment]]
+
+    def append(self, events):
+        offset = self._file.tell()
+        lines = []
+        for event in events:
+            line = (json.dumps(event, separators=(",", ":")) + "\n").encode("utf-8")
+            if self._index is not None and event[3] is not None:
+                self._add(self._index, (event[2], event[3]), (self.segment, offset))
+            offset += len(line)
+            lines.append(line)
+        self._file.write(b"".join(lines))
+        self._file.flush()
+
+    def rotate(self):
+        """Starts a new file, dropping the segments beyond keep_segments"""
+        self._file.close()
+        os.replace(self.path, "{}.{}".format(self.path, self.segment))
+        self.segments.append(self.segment)
+        self.segment += 1
+        self._file = open(self.path, "ab")
+        while len(self.segments) > self.keep_segments:
+            try:
+                os.remove(self.segment_path(self.segments.pop(0)))
+            except OSError:
+                pass
+        if self._index is not None:
+            self._prune(self._index)
+
+    def read(self, start=0, end=None, path=None):
+        """Yields (offset, LedgerEntry) for the lines from start to end"""
+        offset = start
+        with open(path or self.path, "rb") as f:
+            f.seek(start)
+            for line in f:
+                if end is not None and offset >= end:
+                    break
+                yield offset, LedgerEntry(*json.loads(line.decode("utf-8")))
+                offset += len(line)
+
+    def build_index(self, files, end):
+        """Maps accounts to their latest lines, files being the output of
+        files() and end the size of the last one
+
+        Only reads files, so it can run in an executor."""
+        index = {}
+        for i, (segment, path) in enumerate(files):
+            last = i == len(files) - 1
+            try:
+                for offset, entry in self.read(0, end if last else None, path):
+                    if entry.user_id is not None:
+                        self._add(index, (entry.server_id, entry.user_id),
+                                  (segment, offset))
+            except FileNotFoundError: # Rotated away meanwhile
+                continue
+        return index
+
+    def set_index(self, index, segment, end):
+        """Uses an index from build_index, adding what was written since"""
+        if self._index is not None:
+            return
+        for s in [segment] + [s for s in self.segments + [self.segment] if s > segment]:
+            try:
+                for offset, entry in self.read(end if s == segment else 0, None,
+                                               self.segment_path(s)):
+                    if entry.user_id is not None:
+                        self._add(index, (entry.server_id, entry.user_id), (s, offset))
+            except FileNotFoundError:
+                continue
+        self._prune(index)
+        self._index = index
+
+    def history(self, server_id, user_id, limit):
+        """The latest entries of an account, newest first"""
+        if self._index is None:
+            self.set_index(self.build_index(self.files(), self.size),
+                           self.segment, self.size)
+        refs = self._index.get((server_id, user_id), [])[-limit:]
+        entries = []
+        for segment, offset in reversed(refs):
+            with open(self.segment_path(segment), "rb") as f:
+                f.seek(offset)
+                entries.append(LedgerEntry(*json.loads(f.readline().decode("utf-8"))))
+        return entries
+
+    def _add(self, index, key, ref):
+        refs = index.setdefault(key, [])
+        refs.append(ref)
+        if len(refs) > self.max_history:
+            del refs[0]
+
+    def _prune(self, index):
+        # Forgets lines of segments that were deleted
+        oldest = self.segments[0] if self.segments else self.segment
+        for key in list(index):
+            refs = [r for r in index[key] if r[0] >= oldest]
+            if refs:
+                index[key] = refs
+            else:
+                del index[key]
+
+    def _find_segments(self):
+        folder, name = os.path.split(self.path)
+        prefix = name + "."
+        return sorted(int(f[len(prefix):]) for f in os.listdir(folder or ".")
+                      if f.startswith(prefix) and f[len(prefix):].isdigit())
+
+    def close(self):
+        self._file.close()
+
+    def _repair(self):
+        # Drops a line torn by a crash, appending after it would corrupt the next one
+        open(self.path, "ab").close()
+        with open(self.path, "rb+") as f:
+            end = pos = f.seek(0, os.SEEK_END)
+            while pos > 0:
+                step = min(4096, pos)
+                f.seek(pos - step)
+                i = f.read(step).rfind(b"\n")
+                if i != -1:
+                    pos = pos - step + i + 1
+                    break
+                pos -= step
+            if pos != end:
+                f.truncate(pos)
+
+
 class Bank:
-    def __init__(self, bot, file_path):
-        self.accounts = dataIO.load_json(file_path)
+    snapshot_interval = 300 # Seconds between bank.json rewrites, at most
+    snapshot_events = 1000 # Ledger entries that force one sooner
+    rotate_size = 4 * 2**20 # Ledger bytes before a snapshot rotates it
+
+    def __init__(self, bot, file_path, ledger_path="data/economy/ledger.log"):
         self.bot = bot
+        self.file_path = file_path
+        self.snapshot_path = os.path.splitext(ledger_path)[0] + ".json"
+        self.accounts = {} # server id: {user id: AccountRecord}
+        self.legacy_accounts = {} # user id: raw account, from the old format
+        for k, v in dataIO.load_json(file_path).items():
+            if "balance" in v:
+                self.legacy_accounts[k] = v
+            else:
+                self.accounts[k] = {user_id: AccountRecord.from_dict(user_id, acc)
+                                    for user_id, acc in v.items()}
+        self.ledger = Ledger(ledger_path)
+        self._pending = [] # Ledger entries not written yet
+        self._unsaved = 0 # Ledger entries since the last snapshot
+        self._last_snapshot = time.monotonic()
+        if dataIO.is_valid_json(self.snapshot_path):
+            offset = dataIO.load_json(self.snapshot_path)["OFFSET"]
+        else:
+            offset = 0
+        for _, entry in self.ledger.read(offset):
+            self._replay(entry)
+            self._unsaved += 1
+        self.server_leaderboards = {} # server id: Leaderboard of (-balance, user id)
+        self.global_leaderboard = Leaderboard( # (-balance, user id, server id)
+            (-acc.balance, acc.id, server_id)
+            for server_id, server_accounts in self.accounts.items()
+            for acc in server_accounts.values())
+        for server_id in self.accounts:
+            self._rebuild_server_leaderboard(server_id)
+        self._undo = None # Undo actions of the open transaction, if any
+        if self._unsaved:
+            self._save_bank()
+
+    @contextmanager
+    def transaction(self):
+        """Applies every change made in the block with a single save
+
+        If the block raises, its changes are undone and nothing is written.
+        Nested transactions join the outer one. Don't await inside the
+        block, other commands' changes would end up in the transaction."""
+        if self._undo is not None:
+            yield self
+            return
+        self._undo = []
+        try:
+            yield self
+        except Exception:
+            undo, self._undo = self._undo, None
+            del self._pending[:]
+            for action in reversed(undo):
+                action()
+            raise
+        self._undo = None
+        self._commit()
 
     def create_account(self, user, *, initial_balance=0):
         server = user.server
         if not self.account_exists(user):
             if server.id not in self.accounts:
                 self.accounts[server.id] = {}
-            if user.id in self.accounts: # Legacy account
-                balance = self.accounts[user.id]["balance"]
+                self.server_leaderboards[server.id] = Leaderboard()
+            if user.id in self.legacy_accounts: # Legacy account
+                balance = self.legacy_accounts[user.id]["balance"]
             else:
                 balance = initial_balance
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            account = {"name" : user.name,
-                       "balance" : balance,
-                       "created_at" : timestamp
-                      }
+            timestamp = int(time.time())
+            account = AccountRecord(user.id, user.name, balance,
+                                    datetime.fromtimestamp(timestamp))
             self.accounts[server.id][user.id] = account
-            self._save_bank()
+            self.server_leaderboards[server.id].add((-balance, user.id))
+            self.global_leaderboard.add((-balance, user.id, server.id))
+            if self._undo is not None:
+                self._undo.append(lambda: self._remove_account(server.id, account))
+            self._pending.append([timestamp, "open", server.id, user.id, balance,
+                                  balance, user.name])
+            self._commit()
             return self.get_account(user)
         else:
             raise AccountAlreadyExists()
@@ -80,37 +374,29 @@ class Bank:
             return False
         return True
 
-    def withdraw_credits(self, user, amount):
-        server = user.server
-
+    def withdraw_credits(self, user, amount, *, reason="withdraw", extra=None):
         if amount < 0:
             raise NegativeValue()
 
         account = self._get_account(user)
-        if account["balance"] >= amount:
-            account["balance"] -= amount
-            self.accounts[server.id][user.id] = account
-            self._save_bank()
+        if account.balance >= amount:
+            self._change_balance(user.server.id, account, account.balance - amount,
+                                 reason, extra)
         else:
             raise InsufficientBalance()
 
-    def deposit_credits(self, user, amount):
-        server = user.server
+    def deposit_credits(self, user, amount, *, reason="deposit", extra=None):
         if amount < 0:
             raise NegativeValue()
         account = self._get_account(user)
-        account["balance"] += amount
-        self.accounts[server.id][user.id] = account
-        self._save_bank()
+        self._change_balance(user.server.id, account, account.balance + amount,
+                             reason, extra)
 
-    def set_credits(self, user, amount):
-        server = user.server
+    def set_credits(self, user, amount, *, reason="set", extra=None):
         if amount < 0:
             raise NegativeValue()
         account = self._get_account(user)
-        account["balance"] = amount
-        self.accounts[server.id][user.id] = account
-        self._save_bank()
+        self._change_balance(user.server.id, account, amount, reason, extra)
 
     def transfer_credits(self, sender, receiver, amount):
         if amount < 0:
@@ -118,85 +404,373 @@ class Bank:
         if sender is receiver:
             raise SameSenderAndReceiver()
         if self.account_exists(sender) and self.account_exists(receiver):
-            sender_acc = self._get_account(sender)
-            if sender_acc["balance"] < amount:
-                raise InsufficientBalance()
-            self.withdraw_credits(sender, amount)
-            self.deposit_credits(receiver, amount)
+            with self.transaction():
+                self.withdraw_credits(sender, amount, reason="transfer",
+                                      extra=receiver.id)
+                self.deposit_credits(receiver, amount, reason="transfer",
+                                     extra=sender.id)
         else:
             raise NoAccount()
 
     def can_spend(self, user, amount):
-        account = self._get_account(user)
-        if account["balance"] >= amount:
-            return True
-        else:
-            return False
+        return self._get_account(user).balance >= amount
 
     def wipe_bank(self, server):
+        old_accounts = self.accounts.get(server.id, {})
+        for acc in old_accounts.values():
+            self.global_leaderboard.remove((-acc.balance, acc.id, server.id))
+        if self._undo is not None:
+            self._undo.append(lambda: self._restore_server(server.id, old_accounts))
         self.accounts[server.id] = {}
-        self._save_bank()
+        self.server_leaderboards[server.id] = Leaderboard()
+        self._pending.append([int(time.time()), "wipe", server.id, None, None,
+                              None, None])
+        self._commit()
 
     def get_server_accounts(self, server):
         if server.id in self.accounts:
-            raw_server_accounts = deepcopy(self.accounts[server.id])
-            accounts = []
-            for k, v in raw_server_accounts.items():
-                v["id"] = k
-                v["server"] = server
-                acc = self._create_account_obj(v)
-                accounts.append(acc)
-            return accounts
+            return [self._create_account_obj(acc, server)
+                    for acc in self.accounts[server.id].values()]
         else:
             return []
 
     def get_all_accounts(self):
         accounts = []
-        for server_id, v in self.accounts.items():
+        for server_id, server_accounts in self.accounts.items():
             server = self.bot.get_server(server_id)
             if server is None:# Servers that have since been left will be ignored
-                continue      # Same for users_id from the old bank format
-            raw_server_accounts = deepcopy(self.accounts[server.id])
-            for k, v in raw_server_accounts.items():
-                v["id"] = k
-                v["server"] = server
-                acc = self._create_account_obj(v)
-                accounts.append(acc)
+                continue
+            for acc in server_accounts.values():
+                accounts.append(self._create_account_obj(acc, server))
+        return accounts
+
+    def bulk_set_credits(self, server, balances, *, reason="bulk set"):
+        """Sets many balances of a server in one go, {user id: balance}
+
+        Ids without an account are skipped. Returns how many were set."""
+        if any(amount < 0 for amount in balances.values()):
+            raise NegativeValue()
+        server_accounts = self.accounts.get(server.id, {})
+        balances = {user_id: amount for user_id, amount in balances.items()
+                    if user_id in server_accounts}
+        old_balances = {user_id: server_accounts[user_id].balance
+                        for user_id in balances}
+        timestamp = int(time.time())
+        for user_id, amount in balances.items():
+            self._pending.append([timestamp, reason, server.id, user_id, amount,
+                                  amount - old_balances[user_id], None])
+        if old_balances:
+            self._set_balances(server.id, balances)
+            if self._undo is not None:
+                self._undo.append(lambda: self._set_balances(server.id, old_balances))
+            self._commit()
+        return len(old_balances)
+
+    def bulk_deposit_credits(self, server, user_ids, amount, *, reason="bulk deposit"):
+        """Deposits amount to every listed account of a server
+
+        Ids without an account are skipped. Returns how many were credited."""
+        if amount < 0:
+            raise NegativeValue()
+        server_accounts = self.accounts.get(server.id, {})
+        balances = {user_id: server_accounts[user_id].balance + amount
+                    for user_id in user_ids if user_id in server_accounts}
+        return self.bulk_set_credits(server, balances, reason=reason)
+
+    def get_server_leaderboard(self, server, top):
+        """The top accounts of a server, richest first"""
+        server_accounts = self.accounts.get(server.id, {})
+        leaderboard = self.server_leaderboards.get(server.id, ())
+        accounts = []
+        for balance, user_id in leaderboard:
+            if len(accounts) >= top:
+                break
+            accounts.append(self._create_account_obj(server_accounts[user_id],
+                                                     server))
         return accounts
 
+    def get_global_leaderboard(self, top):
+        """The top accounts of every server, once per user
+
+        A user with accounts on several servers is ranked by the richest."""
+        accounts = []
+        seen = set()
+        for balance, user_id, server_id in self.global_leaderboard:
+            if len(accounts) >= top:
+                break
+            if user_id in seen:
+                continue
+            server = self.bot.get_server(server_id)
+            if server is None: # Servers that have since been left are ignored
+                continue
+            seen.add(user_id)
+            acc = self.accounts[server_id][user_id]
+            accounts.append(self._create_account_obj(acc, server))
+        return accounts
+
+    def get_history(self, user, limit=10):
+        """The latest ledger entries of an account, newest first"""
+        return self.ledger.history(user.server.id, user.id, limit)
+
+    def close(self):
+        """Writes a last snapshot and closes the ledger"""
+        self._save_bank()
+        self.ledger.close()
+
     def get_balance(self, user):
-        account = self._get_account(user)
-        return account["balance"]
+        return self._get_account(user).balance
 
     def get_account(self, user):
         acc = self._get_account(user)
-        acc["id"] = user.id
-        acc["server"] = user.server
-        return self._create_account_obj(acc)
-
-    def _create_account_obj(self, account):
-        account["member"] = account["server"].get_member(account["id"])
-        account["created_at"] = datetime.strptime(account["created_at"],
-                                                  "%Y-%m-%d %H:%M:%S")
-        Account = namedtuple("Account", "id name balance "
-                             "created_at server member")
-        return Account(**account)
+        return self._create_account_obj(acc, user.server)
+
+    def _create_account_obj(self, account, server):
+        return Account(account.id, account.name, account.balance,
+                       account.created_at, server,
+                       server.get_member(account.id))
+
+    def _change_balance(self, server_id, account, balance, reason, extra):
+        delta = balance - account.balance
+        self._set_balance(server_id, account, balance)
+        self._pending.append([int(time.time()), reason, server_id, account.id,
+                              balance, delta, extra])
+        self._commit()
+
+    def _set_balance(self, server_id, account, balance):
+        """Changes a balance, keeping the leaderboards sorted"""
+        if balance == account.balance:
+            return
+        self.server_leaderboards[server_id].replace((-account.balance, account.id),
+                                                    (-balance, account.id))
+        self.global_leaderboard.replace((-account.balance, account.id, server_id),
+                                        (-balance, account.id, server_id))
+        if self._undo is not None:
+            old_balance = account.balance
+            self._undo.append(lambda: self._set_balance(server_id, account,
+                                                        old_balance))
+        account.balance = balance
+
+    def _remove_account(self, server_id, account):
+        del self.accounts[server_id][account.id]
+        self.server_leaderboards[server_id].remove((-account.balance, account.id))
+        self.global_leaderboard.remove((-account.balance, account.id, server_id))
+
+    def _restore_server(self, server_id, server_accounts):
+        for acc in self.accounts.get(server_id, {}).values():
+            self.global_leaderboard.remove((-acc.balance, acc.id, server_id))
+        self.accounts[server_id] = server_accounts
+        for acc in server_accounts.values():
+            self.global_leaderboard.add((-acc.balance, acc.id, server_id))
+        self._rebuild_server_leaderboard(server_id)
+
+    def _set_balances(self, server_id, balances):
+        """Changes many balances of a server, {user id: balance}
+
+        Only the changed keys move in the global leaderboard, the server's
+        own is sorted again in one go."""
+        server_accounts = self.accounts[server_id]
+        for user_id, balance in balances.items():
+            acc = server_accounts[user_id]
+            self.global_leaderboard.replace((-acc.balance, acc.id, server_id),
+                                            (-balance, acc.id, server_id))
+            acc.balance = balance
+        self._rebuild_server_leaderboard(server_id)
+
+    def _rebuild_server_leaderboard(self, server_id):
+        self.server_leaderboards[server_id] = Leaderboard(
+            (-acc.balance, acc.id) for acc in self.accounts[server_id].values())
+
+    def _commit(self):
+        """Writes the pending ledger entries, and a snapshot if it's time"""
+        if self._undo is not None: # The transaction commits once it's done
+            return
+        if self._pending:
+            self.ledger.append(self._pending)
+            self._unsaved += len(self._pending)
+            self._pending = []
+        if self._unsaved >= self.snapshot_events or (self._unsaved and
+                time.monotonic() - self._last_snapshot >= self.snapshot_interval):
+            self._save_bank()
+
+    def _replay(self, entry):
+        if entry.kind == "wipe":
+            self.accounts[entry.server_id] = {}
+            return
+        server_accounts = self.accounts.setdefault(entry.server_id, {})
+        account = server_accounts.get(entry.user_id)
+        if account is None or entry.kind == "open":
+            name = entry.extra if entry.kind == "open" else entry.user_id
+            account = AccountRecord(entry.user_id, name, entry.balance,
+                                    datetime.fromtimestamp(entry.timestamp))
+            server_accounts[entry.user_id] = account
+        account.balance = entry.balance
 
     def _save_bank(self):
-        dataIO.save_json("data/economy/bank.json", self.accounts)
+        """Snapshots every balance, the ledger is replayed from here on load"""
+        data = {server_id: {user_id: acc.to_dict()
+                            for user_id, acc in server_accounts.items()}
+                for server_id, server_accounts in self.accounts.items()}
+        data.update(self.legacy_accounts)
+        dataIO.save_json(self.file_path, data)
+        if self.ledger.size >= self.rotate_size:
+            # bank.json covers all of it, replaying the new file is enough
+            dataIO.save_json(self.snapshot_path, {"OFFSET" : 0})
+            self.ledger.rotate()
+        else:
+            dataIO.save_json(self.snapshot_path, {"OFFSET" : self.ledger.size})
+        self._unsaved = 0
+        self._last_snapshot = time.monotonic()
 
     def _get_account(self, user):
         server = user.server
         try:
-            return deepcopy(self.accounts[server.id][user.id])
+            return self.accounts[server.id][user.id]
         except KeyError:
             raise NoAccount()
 
+class SlotMachine:
+    """The slot machine's reels and payout rules
+
+    Every reel stops on a random symbol and the middle row is the payline.
+    A win pays bid * multiplier + bonus and the bid is kept, a loss takes
+    the bid."""
+
+    reel = [":cherries:", ":cookie:", ":two:", ":four_leaf_clover:", ":cyclone:",
+            ":sunflower:", ":six:", ":mushroom:", ":heart:", ":snowflake:"]
+
+    def spin(self):
+        """Three reels, each the symbols above, on and below the payline"""
+        reels = []
+        for i in range(0, 3):
+            n = randrange(len(self.reel))
+            reels.append([self.reel[n - 1], self.reel[n],
+                          self.reel[(n + 1) % len(self.reel)]])
+        return reels
+
+    def evaluate(self, line):
+        """(name, multiplier, bonus) of the payline, multiplier -1 if lost"""
+        if line[0] == ":two:" and line[1] == ":two:" and line[2] == ":six:":
+            return "226", 5000, 0
+        elif line[0] == ":four_leaf_clover:" and line[1] == ":four_leaf_clover:" and line[2] == ":four_leaf_clover:":
+            return "flc", 1, 1000
+        elif line[0] == ":cherries:" and line[1] == ":cherries:" and line[2] == ":cherries:":
+            return "cherries", 1, 800
+        elif line[0] == line[1] == line[2]:
+            return "three", 1, 500
+        elif line[0] == ":two:" and line[1] == ":six:" or line[1] == ":two:" and line[2] == ":six:":
+            return "26", 4, 0
+        elif line[0] == ":cherries:" and line[1] == ":cherries:" or line[1] == ":cherries:" and line[2] == ":cherries:":
+            return "two cherries", 3, 0
+        elif line[0] == line[1] or line[1] == line[2]:
+            return "two", 2, 0
+        else:
+            return "nothing", -1, 0
+
+    def outcomes(self):
+        """(multiplier, bonus) of every payline, all equally likely"""
+        return [self.evaluate([a, b, c])[1:] for a in self.reel
+                for b in self.reel for c in self.reel]
+
+    def expected(self, bid):
+        """Exact mean and variance of a spin's net gain"""
+        gains = [bid * multiplier + bonus for multiplier, bonus in self.outcomes()]
+        mean = sum(gains) / len(gains)
+        return mean, sum((g - mean) ** 2 for g in gains) / len(gains)
+
+    def simulate(self, bids, spins, session=100, seed=None):
+        """Monte Carlo of spins pulls for each bid, needs numpy
+
+        Pulls are grouped in sessions of session pulls, to show how far a
+        player's balance drifts over one. Returns {bid: stats}."""
+        multipliers, bonuses = (numpy.array(a, dtype=numpy.int64)
+                                for a in zip(*self.outcomes()))
+        rng = numpy.random.RandomState(seed)
+        sessions = max(1, spins // session)
+        chunk = max(1, 10**6 // session) # Sessions per batch, bounds memory
+        results = {}
+        for bid in bids:
+            total = 0
+            squares = 0
+            drifts = []
+            for start in range(0, sessions, chunk):
+                draws = rng.randint(0, len(multipliers),
+                                    size=(min(chunk, sessions - start), session))
+                gains = multipliers[draws] * bid + bonuses[draws]
+                total += int(gains.sum())
+                squares += float((gains.astype(numpy.float64) ** 2).sum())
+                drifts.append(gains.sum(axis=1))
+            drifts = numpy.concatenate(drifts)
+            n = sessions * session
+            mean = total / n
+            results[bid] = {"mean": mean,
+                            "std": math.sqrt(max(0, squares / n - mean ** 2)),
+                            "drift_mean": float(drifts.mean()),
+                            "drift_p5": float(numpy.percentile(drifts, 5)),
+                            "drift_p95": float(numpy.percentile(drifts, 95)),
+                            "ahead": float((drifts > 0).mean())}
+        return results
+
+
+class CooldownRegistry:
+    """When users last used a command, per command and server
+
+    Timestamps are wall clock, so they can be saved and still mean
+    something after a restart. sweep() drops the ones whose cooldown is
+    over, so only users still cooling down take up memory."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._stamps = {} # kind: {server id: {user id: timestamp}}
+        self._dirty = False
+        if path is not None and dataIO.is_valid_json(path):
+            self._stamps = dataIO.load_json(path)
+
+    def remaining(self, kind, server_id, user_id, cooldown):
+        """Seconds left before the user can use kind again, 0 if none"""
+        try:
+            stamp = self._stamps[kind][server_id][user_id]
+        except KeyError:
+            return 0
+        elapsed = max(0, time.time() - stamp) # The clock may have gone back
+        return max(0, cooldown - elapsed)
+
+    def trigger(self, kind, server_id, user_id):
+        servers = self._stamps.setdefault(kind, {})
+        servers.setdefault(server_id, {})[user_id] = time.time()
+        self._dirty = True
+
+    def sweep(self, kind, cooldown_for):
+        """Drops the expired entries of kind
+
+        cooldown_for maps a server id to its cooldown in seconds."""
+        now = time.time()
+        servers = self._stamps.get(kind, {})
+        for server_id in list(servers):
+            cooldown = cooldown_for(server_id)
+            users = servers[server_id]
+            expired = [user_id for user_id, stamp in users.items()
+                       if not 0 <= now - stamp < cooldown]
+            for user_id in expired:
+                del users[user_id]
+            if not users:
+                del servers[server_id]
+            if expired:
+                self._dirty = True
+
+    def save(self):
+        if self.path is not None and self._dirty:
+            dataIO.save_json(self.path, self._stamps)
+            self._dirty = False
+
+
 class Economy:
     """Economy
 
     Get rich and have fun with imaginary currency!"""
 
+    persist_cooldowns = True # Cooldowns survive restarts
+    sweep_interval = 300 # Seconds between cooldown sweeps and saves
+
     def __init__(self, bot):
         global default_settings
         self.bot = bot
@@ -207,8 +781,27 @@ class Economy:
             default_settings = self.settings
             self.settings = {}
         self.settings = defaultdict(lambda: default_settings, self.settings)
-        self.payday_register = defaultdict(dict)
-        self.slot_register = defaultdict(dict)
+        self.machine = SlotMachine()
+        self.cooldowns = CooldownRegistry("data/economy/cooldowns.json"
+                                          if self.persist_cooldowns else None)
+        self.session = aiohttp.ClientSession(loop=self.bot.loop)
+        self.sweeper = self.bot.loop.create_task(self.cooldown_sweeper())
+
+    def __unload(self):
+        self.sweeper.cancel()
+        self.cooldowns.save()
+        self.bank.close()
+        self.session.close()
+
+    def sweep_cooldowns(self):
+        self.cooldowns.sweep("payday", lambda sid: self.settings.get(sid, default_settings)["PAYDAY_TIME"])
+        self.cooldowns.sweep("slot", lambda sid: self.settings.get(sid, default_settings)["SLOT_TIME"])
+        self.cooldowns.save()
+
+    async def cooldown_sweeper(self):
+        while self == self.bot.get_cog("Economy"):
+            self.sweep_cooldowns()
+            await asyncio.sleep(self.sweep_interval)
 
     @commands.group(name="bank", pass_context=True)
     async def _bank(self, ctx):
@@ -263,6 +856,39 @@ class Economy:
         except NoAccount:
             await self.bot.say("That user has no bank account.")
 
+    @_bank.command(pass_context=True, no_pm=True)
+    async def history(self, ctx, user : discord.Member=None, entries : int=10):
+        """Shows the latest changes to a bank account
+
+        Defaults to yours."""
+        if not user:
+            user = ctx.message.author
+        if not self.bank.account_exists(user):
+            await self.bot.say("That user has no bank account.")
+            return
+        ledger = self.bank.ledger
+        if not ledger.indexed: # Reading the whole ledger once, off the event loop
+            files, segment, end = ledger.files(), ledger.segment, ledger.size
+            index = await self.bot.loop.run_in_executor(None, ledger.build_index,
+                                                        files, end)
+            ledger.set_index(index, segment, end)
+        history = self.bank.get_history(user, max(1, min(entries, 50)))
+        msg = ""
+        for entry in history:
+            when = datetime.fromtimestamp(entry.timestamp).strftime("%Y-%m-%d %H:%M")
+            kind = entry.kind
+            if entry.kind == "transfer":
+                other = user.server.get_member(entry.extra)
+                kind += (" to " if entry.delta < 0 else " from ") + \
+                        (other.name if other else entry.extra)
+            msg += "{} {} {:+} = {}\n".format(when, kind.ljust(14), entry.delta, entry.balance)
+        if not msg:
+            await self.bot.say("There's no history for that account yet.")
+        elif len(msg) < 1985:
+            await self.bot.say("```\n" + msg + "```")
+        else:
+            await self.bot.say("The history is too long to be displayed. Try with fewer entries.")
+
     @_bank.command(name="set", pass_context=True)
     @checks.admin_or_permissions(manage_server=True)
     async def _set(self, ctx, user : discord.Member, sum : int):
@@ -277,6 +903,119 @@ class Economy:
         except NoAccount:
             await self.bot.say("User has no bank account.")
 
+    @_bank.group(name="bulk", pass_context=True, no_pm=True)
+    @checks.admin_or_permissions(manage_server=True)
+    async def _bulk(self, ctx):
+        """Changes many bank accounts at once
+
+        Admin/owner restricted."""
+        if ctx.invoked_subcommand is None or \
+                isinstance(ctx.invoked_subcommand, commands.Group):
+            await send_cmd_help(ctx)
+
+    @_bulk.command(name="deposit", pass_context=True)
+    async def _bulk_deposit(self, ctx, sum : int, role : discord.Role=None):
+        """Gives credits to everyone with an account
+
+        Only to the members of role, if given."""
+        server = ctx.message.server
+        user_ids = self._bulk_targets(server, role)
+        try:
+            changed = self.bank.bulk_deposit_credits(server, user_ids, sum)
+        except NegativeValue:
+            await self.bot.say("The sum can't be negative.")
+            return
+        self._log_bulk(ctx, "deposited {} credits to".format(sum), changed, role)
+        msg = "{} credits deposited to {} accounts.".format(sum, changed)
+        await self.bot.say(msg + self._no_account_note(user_ids, changed))
+
+    @_bulk.command(name="set", pass_context=True)
+    async def _bulk_set(self, ctx, sum : int, role : discord.Role=None):
+        """Sets the credits of everyone with an account
+
+        Only of the members of role, if given."""
+        server = ctx.message.server
+        user_ids = self._bulk_targets(server, role)
+        try:
+            changed = self.bank.bulk_set_credits(server, dict.fromkeys(user_ids, sum))
+        except NegativeValue:
+            await self.bot.say("Credits can't be negative.")
+            return
+        self._log_bulk(ctx, "set {} credits to".format(sum), changed, role)
+        msg = "{} accounts now have {} credits.".format(changed, sum)
+        await self.bot.say(msg + self._no_account_note(user_ids, changed))
+
+    @_bulk.command(name="export", pass_context=True)
+    async def _bulk_export(self, ctx):
+        """Uploads the server's balances as a CSV file"""
+        server = ctx.message.server
+        data = io.StringIO()
+        writer = csv.writer(data)
+        writer.writerow(("id", "name", "balance"))
+        for acc in self.bank.get_server_accounts(server):
+            writer.writerow((acc.id, acc.name, acc.balance))
+        f = io.BytesIO(data.getvalue().encode("utf-8"))
+        await self.bot.upload(f, filename="bank-{}.csv".format(server.id))
+
+    @_bulk.command(name="import", pass_context=True)
+    async def _bulk_import(self, ctx):
+        """Sets balances from an attached CSV file
+
+        The file needs id and balance columns, like the one made by
+        bank bulk export. Users without an account are skipped."""
+        server = ctx.message.server
+        attachments = ctx.message.attachments
+        if not attachments:
+            await self.bot.say("Attach the CSV file to the command's message.")
+            return
+        try:
+            async with self.session.get(attachments[0]["url"]) as r:
+                text = await r.text(encoding="utf-8-sig") # Excel adds a BOM
+        except aiohttp.ClientError:
+            await self.bot.say("I couldn't download that file.")
+            return
+        reader = csv.DictReader(io.StringIO(text))
+        if not reader.fieldnames or "id" not in reader.fieldnames or \
+                "balance" not in reader.fieldnames:
+            await self.bot.say("The file needs id and balance columns.")
+            return
+        balances = {}
+        invalid = 0
+        for row in reader:
+            user_id = (row["id"] or "").strip()
+            try:
+                balance = int(row["balance"])
+            except (TypeError, ValueError):
+                balance = -1
+            if not user_id.isdigit() or balance < 0:
+                invalid += 1
+                continue
+            balances[user_id] = balance
+        changed = self.bank.bulk_set_credits(server, balances, reason="import")
+        self._log_bulk(ctx, "imported balances for", changed, None)
+        msg = "{} balances imported.".format(changed)
+        msg += self._no_account_note(balances, changed)
+        if invalid:
+            msg += " {} rows were invalid.".format(invalid)
+        await self.bot.say(msg)
+
+    def _bulk_targets(self, server, role):
+        if role is None:
+            return [acc.id for acc in self.bank.get_server_accounts(server)]
+        return [m.id for m in server.members if role in m.roles]
+
+    def _no_account_note(self, user_ids, changed):
+        if len(user_ids) > changed:
+            return " {} users had no account.".format(len(user_ids) - changed)
+        return ""
+
+    def _log_bulk(self, ctx, action, changed, role):
+        author = ctx.message.author
+        target = "the members of {}".format(role.name) if role else "everyone"
+        logger.info("{}({}) {} {} ({} accounts) on {}({})".format(
+            author.name, author.id, action, target, changed,
+            ctx.message.server.name, ctx.message.server.id))
+
     @commands.command(pass_context=True, no_pm=True)
     async def payday(self, ctx): # TODO
         """Get some free credits"""
@@ -284,18 +1023,13 @@ class Economy:
         server = author.server
         id = author.id
         if self.bank.account_exists(author):
-            if id in self.payday_register[server.id]:
-                seconds = abs(self.payday_register[server.id][id] - int(time.perf_counter()))
-                if seconds  >= self.settings[server.id]["PAYDAY_TIME"]:
-                    self.bank.deposit_credits(author, self.settings[server.id]["PAYDAY_CREDITS"])
-                    self.payday_register[server.id][id] = int(time.perf_counter())
-                    await self.bot.say("{} Here, take some credits. Enjoy! (+{} credits!)".format(author.mention, str(self.settings[server.id]["PAYDAY_CREDITS"])))
-                else:
-                    await self.bot.say("{} Too soon. For your next payday you have to wait {}.".format(author.mention, self.display_time(self.settings[server.id]["PAYDAY_TIME"] - seconds)))
-            else:
-                self.payday_register[server.id][id] = int(time.perf_counter())
-                self.bank.deposit_credits(author, self.settings[server.id]["PAYDAY_CREDITS"])
+            seconds = self.cooldowns.remaining("payday", server.id, id, self.settings[server.id]["PAYDAY_TIME"])
+            if not seconds:
+                self.bank.deposit_credits(author, self.settings[server.id]["PAYDAY_CREDITS"], reason="payday")
+                self.cooldowns.trigger("payday", server.id, id)
                 await self.bot.say("{} Here, take some credits. Enjoy! (+{} credits!)".format(author.mention, str(self.settings[server.id]["PAYDAY_CREDITS"])))
+            else:
+                await self.bot.say("{} Too soon. For your next payday you have to wait {}.".format(author.mention, self.display_time(math.ceil(seconds))))
         else:
             await self.bot.say("{} You need an account to receive credits. Type {}bank register to open one.".format(author.mention, ctx.prefix))
 
@@ -315,11 +1049,8 @@ class Economy:
         server = ctx.message.server
         if top < 1:
             top = 10
-        bank_sorted = sorted(self.bank.get_server_accounts(server),
-         key=lambda x: x.balance, reverse=True)
-        if len(bank_sorted) < top:
-            top = len(bank_sorted)
-        topten = bank_sorted[:top]
+        topten = self.bank.get_server_leaderboard(server, top)
+        top = len(topten)
         highscore = ""
         place = 1
         for acc in topten:
@@ -342,15 +1073,8 @@ class Economy:
         Defaults to top 10"""
         if top < 1:
             top = 10
-        bank_sorted = sorted(self.bank.get_all_accounts(),
-         key=lambda x: x.balance, reverse=True)
-        unique_accounts = []
-        for acc in bank_sorted:
-            if not self.already_in_list(unique_accounts, acc):
-                unique_accounts.append(acc)
-        if len(unique_accounts) < top:
-            top = len(unique_accounts)
-        topten = unique_accounts[:top]
+        topten = self.bank.get_global_leaderboard(top)
+        top = len(topten)
         highscore = ""
         place = 1
         for acc in topten:
@@ -366,12 +1090,6 @@ class Economy:
         else:
             await self.bot.say("There are no accounts in the bank.")
 
-    def already_in_list(self, accounts, user):
-        for acc in accounts:
-            if user.id == acc.id:
-                return True
-        return False
-
     @commands.command()
     async def payouts(self):
         """Shows slot machine payouts"""
@@ -387,66 +1105,90 @@ class Economy:
             return
         if self.bank.can_spend(author, bid):
             if bid >= self.settings[server.id]["SLOT_MIN"] and bid <= self.settings[server.id]["SLOT_MAX"]:
-                if author.id in self.slot_register:
-                    if abs(self.slot_register[author.id] - int(time.perf_counter()))  >= self.settings[server.id]["SLOT_TIME"]:
-                        self.slot_register[author.id] = int(time.perf_counter())
-                        await self.slot_machine(ctx.message, bid)
-                    else:
-                        await self.bot.say("Slot machine is still cooling off! Wait {} seconds between each pull".format(self.settings[server.id]["SLOT_TIME"]))
-                else:
-                    self.slot_register[author.id] = int(time.perf_counter())
+                if not self.cooldowns.remaining("slot", server.id, author.id, self.settings[server.id]["SLOT_TIME"]):
+                    self.cooldowns.trigger("slot", server.id, author.id)
                     await self.slot_machine(ctx.message, bid)
+                else:
+                    await self.bot.say("Slot machine is still cooling off! Wait {} seconds between each pull".format(self.settings[server.id]["SLOT_TIME"]))
             else:
                 await self.bot.say("{0} Bid must be between {1} and {2}.".format(author.mention, self.settings[server.id]["SLOT_MIN"], self.settings[server.id]["SLOT_MAX"]))
         else:
             await self.bot.say("{0} You need an account with enough funds to play the slot machine.".format(author.mention))
 
     async def slot_machine(self, message, bid):
-        reel_pattern = [":cherries:", ":cookie:", ":two:", ":four_leaf_clover:", ":cyclone:", ":sunflower:", ":six:", ":mushroom:", ":heart:", ":snowflake:"]
-        padding_before = [":mushroom:", ":heart:", ":snowflake:"] # padding prevents index errors
-        padding_after = [":cherries:", ":cookie:", ":two:"]
-        reel = padding_before + reel_pattern + padding_after
-        reels = []
-        for i in range(0, 3):
-            n = randint(3,12)
-            reels.append([reel[n - 1], reel[n], reel[n + 1]])
+        reels = self.machine.spin()
         line = [reels[0][1], reels[1][1], reels[2][1]]
 
         display_reels = "~~\n~~  " + reels[0][0] + " " + reels[1][0] + " " + reels[2][0] + "\n"
         display_reels += ">" + reels[0][1] + " " + reels[1][1] + " " + reels[2][1] + "\n"
         display_reels += "  " + reels[0][2] + " " + reels[1][2] + " " + reels[2][2] + "\n"
 
-        if line[0] == ":two:" and line[1] == ":two:" and line[2] == ":six:":
-            bid = bid * 5000
-            slotMsg = "{}{} 226! Your bet is multiplied * 5000! {}! ".format(display_reels, message.author.mention, str(bid))
-        elif line[0] == ":four_leaf_clover:" and line[1] == ":four_leaf_clover:" and line[2] == ":four_leaf_clover:":
-            bid += 1000
-            slotMsg = "{}{} Three FLC! +1000! ".format(display_reels, message.author.mention)
-        elif line[0] == ":cherries:" and line[1] == ":cherries:" and line[2] == ":cherries:":
-            bid += 800
-            slotMsg = "{}{} Three cherries! +800! ".format(display_reels, message.author.mention)
-        elif line[0] == line[1] == line[2]:
-            bid += 500
-            slotMsg = "{}{} Three symbols! +500! ".format(display_reels, message.author.mention)
-        elif line[0] == ":two:" and line[1] == ":six:" or line[1] == ":two:" and line[2] == ":six:":
-            bid = bid * 4
-            slotMsg = "{}{} 26! Your bet is multiplied * 4! {}! ".format(display_reels, message.author.mention, str(bid))
-        elif line[0] == ":cherries:" and line[1] == ":cherries:" or line[1] == ":cherries:" and line[2] == ":cherries:":
-            bid = bid * 3
-            slotMsg = "{}{} Two cherries! Your bet is multiplied * 3! {}! ".format(display_reels, message.author.mention, str(bid))
-        elif line[0] == line[1] or line[1] == line[2]:
-            bid = bid * 2
-            slotMsg = "{}{} Two symbols! Your bet is multiplied * 2! {}! ".format(display_reels, message.author.mention, str(bid))
+        messages = {"226" : "226! Your bet is multiplied * 5000! {}! ",
+                    "flc" : "Three FLC! +1000! ",
+                    "cherries" : "Three cherries! +800! ",
+                    "three" : "Three symbols! +500! ",
+                    "26" : "26! Your bet is multiplied * 4! {}! ",
+                    "two cherries" : "Two cherries! Your bet is multiplied * 3! {}! ",
+                    "two" : "Two symbols! Your bet is multiplied * 2! {}! "}
+        name, multiplier, bonus = self.machine.evaluate(line)
+        if name in messages:
+            bid = bid * multiplier + bonus
+            slotMsg = "{}{} ".format(display_reels, message.author.mention) + messages[name].format(str(bid))
         else:
             slotMsg = "{}{} Nothing! Lost bet. ".format(display_reels, message.author.mention)
-            self.bank.withdraw_credits(message.author, bid)
+            self.bank.withdraw_credits(message.author, bid, reason="slot")
             slotMsg += "\n" + " Credits left: {}".format(self.bank.get_balance(message.author))
             await self.bot.send_message(message.channel, slotMsg)
             return True
-        self.bank.deposit_credits(message.author, bid)
+        self.bank.deposit_credits(message.author, bid, reason="slot")
         slotMsg += "\n" + " Current credits: {}".format(self.bank.get_balance(message.author))
         await self.bot.send_message(message.channel, slotMsg)
 
+    @commands.command(pass_context=True, no_pm=True)
+    @checks.is_owner()
+    async def slotsim(self, ctx, spins : int=1000000, *bids : int):
+        """Simulates the slot machine to check the economy's balance
+
+        Defaults to the server's minimum, middle and maximum bid."""
+        settings = self.settings[ctx.message.server.id]
+        if not bids:
+            bids = sorted({settings["SLOT_MIN"], settings["SLOT_MAX"],
+                           (settings["SLOT_MIN"] + settings["SLOT_MAX"]) // 2})
+        spins = max(100, min(spins, 10**8))
+        session = 100
+        if numpy is None:
+            await self.bot.say("Simulating needs numpy: `pip3 install numpy`. "
+                               "Showing the exact odds only.")
+            results = {}
+        else:
+            await self.bot.say("Simulating {} spins per bid...".format(spins))
+            results = await self.bot.loop.run_in_executor(
+                None, self.machine.simulate, bids, spins, session)
+        msg = "Bid      EV/spin     Std dev"
+        if results:
+            msg += "       Drift      5%..95%     Ahead"
+        msg += "\n"
+        for bid in bids:
+            mean, variance = self.machine.expected(bid)
+            msg += "{:<6} {:>9.1f} {:>11.1f}".format(bid, mean, math.sqrt(variance))
+            if bid in results:
+                r = results[bid]
+                msg += "   {:>9.0f} {:>7.0f}..{:<7.0f} {:>4.0%}".format(
+                    r["drift_mean"], r["drift_p5"], r["drift_p95"], r["ahead"])
+            msg += "\n"
+        if results:
+            msg += "Drift is the net gain over {} spins.\n".format(session)
+        msg += "\nPayday: {} credits every {}".format(
+            settings["PAYDAY_CREDITS"], self.display_time(settings["PAYDAY_TIME"]) or "0 seconds")
+        if settings["SLOT_TIME"] > 0:
+            pulls = 3600 / settings["SLOT_TIME"]
+            msg += "\nAt most {:.0f} pulls an hour, worth {:.0f} credits on average at the maximum bid".format(
+                pulls, pulls * self.machine.expected(settings["SLOT_MAX"])[0])
+        if len(msg) < 1985:
+            await self.bot.say("```\n" + msg + "```")
+        else:
+            await self.bot.say("Too many bids to display. Try with fewer.")
+
     @commands.group(pass_context=True, no_pm=True)
     @checks.admin_or_permissions(manage_server=True)
     async def economyset(self, ctx):